@@ -3,21 +3,28 @@
 # Copyright (c) 2019 - 2023 SeaHOH <SeaHOH@gmail.com>
 
 
+import sys
 import platform
 import jsengine.detect as _d
 from jsengine.exceptions import *
 from jsengine.abstract import AbstractJSEngine
 from jsengine.internal import V8JSEngine, ChakraJSEngine, QuickJSEngine
 from jsengine.external import ExternalJSEngine, ExternalInterpreter
+from jsengine.pool import ContextPool
 
 
 __version__ = '1.0.7post1'
 
 __all__ = ['JSEngine', 'V8JSEngine', 'ChakraJSEngine', 'QuickJSEngine', 'ExternalJSEngine',
-           'ExternalInterpreter', 'set_external_interpreter',
+           'ExternalInterpreter', 'set_external_interpreter', 'ContextPool',
+           'ProcessPoolJSEngine',
            'Error', 'RuntimeError', 'ProgramError',
+           'LimitError', 'TimeoutError', 'MemoryLimitError',
            'jsengine', 'eval', 'set_threading']
 
+if sys.version_info >= (3, 5):
+    __all__ += ['AsyncJSEngine', 'aeval']
+
 
 def set_external_interpreter(interpreter, *args, **kwargs):
     '''
@@ -30,25 +37,49 @@ def set_external_interpreter(interpreter, *args, **kwargs):
     return interpreter
 
 
-if _d.external_interpreter:
-    _d.external_interpreter = ExternalInterpreter(_d.external_interpreter)
-
-# Prefer InternalJSEngine (via dynamic library loading)
-if _d.quickjs_available:
-    JSEngine = QuickJSEngine     # The fastest loading
-elif _d.chakra_available:
-    JSEngine = ChakraJSEngine    # High performance
-elif _d.v8_available:
-    JSEngine = V8JSEngine        # High performance
-                                 # but superfluous calling caused by scope issue
-elif _d.external_interpreter:
-    JSEngine = ExternalJSEngine  # Very slow loading, and one result one loading
+def _get_jsengine():
+    global JSEngine
+    if 'JSEngine' in globals():
+        return JSEngine
+
+    # Prefer InternalJSEngine (via dynamic library loading)
+    if _d.quickjs_available:
+        JSEngine = QuickJSEngine     # The fastest loading
+    elif _d.chakra_available:
+        JSEngine = ChakraJSEngine    # High performance
+    elif _d.v8_available:
+        JSEngine = V8JSEngine        # High performance
+    elif _d.external_interpreter:
+        JSEngine = ExternalJSEngine  # Very slow loading, and one result one loading
+    else:
+        JSEngine = None
+    return JSEngine
+
+if sys.version_info >= (3, 7):
+    # Detect the default engine and load asyncio at first use
+    def __getattr__(name):
+        if name == 'JSEngine':
+            return _get_jsengine()
+        if name in ('AsyncJSEngine', 'aeval'):
+            from jsengine import aio
+            globals().update(AsyncJSEngine=aio.AsyncJSEngine, aeval=aio.aeval)
+            return globals()[name]
+        if name == 'ProcessPoolJSEngine':
+            from jsengine.process import ProcessPoolJSEngine
+            globals().update(ProcessPoolJSEngine=ProcessPoolJSEngine)
+            return ProcessPoolJSEngine
+        raise AttributeError('module %r has no attribute %r' % (__name__, name))
 else:
-    JSEngine = None
+    _d.detect()
+    _get_jsengine()
+    from jsengine.process import ProcessPoolJSEngine
+    if sys.version_info >= (3, 5):
+        from jsengine.aio import AsyncJSEngine, aeval
 
 
 def jsengine():
     '''Create a context of the default Javascript engine.'''
+    JSEngine = _get_jsengine()
     if JSEngine:
         return JSEngine()
 
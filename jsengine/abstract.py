@@ -1,5 +1,21 @@
-from jsengine.util import to_unicode, json_encoder, lockmethod, get_exec_code
+from __future__ import print_function
+
+from jsengine.exceptions import *
+from jsengine.util import (to_unicode, json_encoder, lockmethod, get_exec_code,
+                           bytes_marker, split_last_statement, split_member_expression)
+from jsengine.stats import Stats, timer
+from collections import deque
+from itertools import count
 import threading
+import copy
+import weakref
+import sys
+import re
+
+try:
+    from queue import Queue, Full, Empty
+except ImportError:  # py2
+    from Queue import Queue, Full, Empty
 
 
 # Some simple compatibility processing
@@ -18,12 +34,79 @@ if (typeof {gobject} !== 'undefined')
     delete {gobject}
 '''
 
+# Call the function with every arguments, catch the errors one by one
+call_many_script = u'''\
+;{args_list}.map(args => {{
+    try {{
+        return [true, {call}]
+    }}
+    catch (err) {{
+        return [false, String(err)]
+    }}
+}})'''
+
+
+# Decode the base64 strings of memoryview arguments to Uint8Array
+bytes_decoder_script = u'''\
+(s => {
+    var t = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/'
+    var m = new Uint8Array(128), i, j, v, n = s.length
+    for (i = 0; i < 64; i++)
+        m[t.charCodeAt(i)] = i
+    var out = new Uint8Array(n / 4 * 3 - (s[n - 1] === '=') - (s[n - 2] === '='))
+    for (i = 0, j = 0; i < n; i += 4) {
+        v = m[s.charCodeAt(i)] << 18 | m[s.charCodeAt(i + 1)] << 12 |
+            m[s.charCodeAt(i + 2)] << 6 | m[s.charCodeAt(i + 3)]
+        out[j++] = v >> 16
+        if (j < out.length) out[j++] = v >> 8 & 255
+        if (j < out.length) out[j++] = v & 255
+    }
+    return out
+})'''
+
+bytes_call_script = u'''\
+;(_JSEngineBytes => {code})({decoder})'''
+
+# Keep the resolved function in a registry, it is called by its key later.
+# The error of resolving is thrown by the calls, the registration never fails.
+function_register_script = u'''\
+;(function(global) {{
+    if (!global._JSEngineFunctions)
+        Object.defineProperty(global, '_JSEngineFunctions', {{value: {{}}}})
+    try {{
+        global._JSEngineFunctions[{key}] = {function}
+    }}
+    catch (err) {{
+        global._JSEngineFunctions[{key}] = function() {{ throw err }}
+    }}
+}})(function() {{ return this }}());
+'''
+
+function_expression = u'_JSEngineFunctions[%d]'
+
+# Bind the method to its object, same as the receiver of `call`
+function_bind_script = u'''\
+(function(o) {{ var f = o{accessor}; return typeof f == 'function' ? f.bind(o) : f }})(({object}
+))'''
+
+_sub_bytes = re.compile(r'"%s([A-Za-z0-9+/=]*)"' %
+                        re.escape(json_encoder.encode(bytes_marker)[1:-1])).sub
+
 
 class AbstractJSEngine(object):  # Just a naming, no abc
 
     threading = False
+    # The thread of the running output iterator, see `iter_output`
+    _output_thread = None
+    # Whether the output of the stand source is muted when it runs, see `clone`
+    _mute_stand_source = False
+    # Whether the functions or scripts have been called, see `clone`
+    _functions_called = False
+    # Whether the output is passed while the code is running, or after that
+    live_output = True
 
-    def __init__(self, source=u'', init_global=False, init_del_gobjects=[]):
+    def __init__(self, source=u'', init_global=False, init_del_gobjects=[],
+                       history=None, on_output=None, timeout=None, memory_limit=None):
         '''Create a JSEngine content.
 
         Params:
@@ -33,13 +116,38 @@ class AbstractJSEngine(object):  # Just a naming, no abc
                 set True to ensure `global` and `globalThis` are available.
             init_del_gobjects:
                 use to delete some variables in the global.
+            history:
+                how many evaluated code will be kept in the source, the appended
+                code is always kept. None means all, 0 means none of them.
+                For ExternalJSEngine (not persistent), the evaluated code which
+                is not kept will not take effect in the later evaluations.
+            on_output:
+                a callable, it will be called with every line of the console
+                output, e.g. `console.log`, without the line break. It also can
+                be set as the attribute `on_output` later.
+            timeout:
+                the maximum seconds of every evaluation, None means no limit.
+                It raises TimeoutError when the time is up.
+            memory_limit:
+                the maximum bytes of the Javascript heap, None means no limit.
+                It raises MemoryLimitError when the memory is exhausted.
+                Both of them can be set as the attributes later, or be passed
+                to `eval/call/call_many` for a single evaluation.
         '''
         if self.threading:
             self._lock = threading.RLock()
         else:
             self._lock = None
+        self.stats = Stats()
+        self.on_output = on_output
+        self.timeout = timeout
+        self.memory_limit = memory_limit
+        self._call_limits = None, None
         self._source = []
+        self._history = None if history is None else deque(maxlen=history)
         self._stand_source = []
+        self._functions = set()  # keys of the registered functions
+        self._function_handles = {}  # the returned functions and scripts
         init_script = []
         if init_global:
             init_script.append(init_global_script)
@@ -48,16 +156,32 @@ class AbstractJSEngine(object):  # Just a naming, no abc
                 init_script.append(init_del_gobject_script.format(gobject=gobject))
         self.append(u''.join(init_script))
         self.append(source)
+        self._init_stand_source = list(self._stand_source)
 
     @property
     @lockmethod
     def source(self):
         '''All the inputted Javascript code.'''
         self._append_stand_source()
-        return u'\n'.join(self._source)
+        return u'\n'.join(self._source_list())
+
+    def _source_list(self, code=None):
+        # Return all the kept code, the passed code will be placed at the end
+        source = self._source
+        if self._history:
+            source = source + list(self._history)
+        if code is not None and not (source and source[-1] is code):
+            source = source + [code]
+        return source
+
+    def _check_code(self, code, last_source):
+        start = timer()
+        code = self._convert_code(code, last_source)
+        self.stats.add('check_code', timer() - start, code and len(code) or 0)
+        return code
 
     @staticmethod
-    def _check_code(code, last_source):
+    def _convert_code(code, last_source):
         # Input unicode
         code = to_unicode(code)
         first_c = code.lstrip()[:1]
@@ -74,7 +198,77 @@ class AbstractJSEngine(object):  # Just a naming, no abc
             code = u'\n'.join(self._stand_source)
             self._stand_source = []
             self._source.append(code)
+            muted, self._mute_stand_source = self._mute_stand_source, False
+            start = timer()
+            try:
+                if muted:
+                    self._append_muted(code)
+                else:
+                    self._append(code)
+            except Error:
+                self.stats.incr('errors')
+                raise
+            finally:
+                self.stats.add('flush', timer() - start, len(code))
+
+    def _append_muted(self, code):
+        # Run the code which has been ran before, e.g. the source of a cloned
+        # context, its output has been passed
+        on_output, self.on_output = self.on_output, None
+        try:
             self._append(code)
+        finally:
+            self.on_output = on_output
+
+    @lockmethod
+    def reset(self):
+        '''Reset the context to the clean state after its initialization.'''
+        self._source = []
+        if self._history:
+            self._history.clear()
+        self._stand_source = list(self._init_stand_source)
+        self._mute_stand_source = False
+        self._functions = set()
+        self._functions_called = False
+        self._reset()
+        self._append_stand_source()
+
+    @lockmethod
+    def clone(self):
+        '''Return a new context which has the same settings and kept source, the
+        source will be ran at once in the new context before its first use.
+        The evaluated code which is kept becomes a part of the source, and the
+        new context is reset to the clean state after the original context's
+        initialization. The calls of functions and scripts are not kept, the
+        changes of the state made by them are not cloned, it warns about them.
+        '''
+        if self._functions_called:
+            print('The calls of functions and scripts are not cloned, the '
+                  'changes of the state made by them are lost.', file=sys.stderr)
+        ctx = copy.copy(self)
+        ctx._lock = None if self._lock is None else threading.RLock()
+        ctx.stats = Stats()
+        ctx._call_limits = None, None
+        kept = self._source_list()
+        ctx._stand_source = kept + self._stand_source
+        ctx._mute_stand_source = self._mute_stand_source or bool(kept)
+        ctx._source = []
+        if self._history is not None:
+            ctx._history = deque(maxlen=self._history.maxlen)
+        ctx._functions = set(self._functions)
+        ctx._function_handles = {}  # they are bound to the original
+        ctx._functions_called = False
+        ctx._clone()
+        return ctx
+
+    def _clone(self):
+        # Create the backend of a cloned context, its attributes are shallow
+        # copied from the original context
+        raise NotImplementedError
+
+    def close(self):
+        '''Release the resources of the context.'''
+        pass
 
     @lockmethod
     def append(self, code):
@@ -84,39 +278,397 @@ class AbstractJSEngine(object):  # Just a naming, no abc
             self._stand_source.append(code)
 
     @lockmethod
-    def eval(self, code):
-        '''Run Javascript code and return result.'''
+    def eval(self, code, timeout=None, memory_limit=None):
+        '''Run Javascript code and return result. The limits of the context are
+        used if `timeout` or `memory_limit` is None.
+        '''
+        code = self._prepare_eval(code)
+        if code:
+            return self._execute(self._eval, code, timeout, memory_limit)
+
+    def iter_output(self, code):
+        '''Run Javascript code, return an iterator of its console output lines.
+        The result is set as the attribute `result` of the iterator when the
+        iteration is finished, and the error is raised at the end. Close the
+        iterator, or use it as a context manager, if the loop may break.
+        '''
+        return OutputIterator(self, code)
+
+    def _get_limits(self):
+        # Return (timeout, memory_limit) of current evaluation
+        timeout, memory_limit = self._call_limits
+        if timeout is None:
+            timeout = self.timeout
+        if memory_limit is None:
+            memory_limit = self.memory_limit
+        return timeout, memory_limit
+
+    def _output_callback(self):
+        # Return a callback which passes the output to `on_output`, it does
+        # not keep the context alive
+        ref = weakref.ref(self)
+        def output(line):
+            ctx = ref()
+            if ctx is not None and ctx.on_output is not None:
+                ctx.on_output(line)
+        return output
+
+    def _prepare_eval(self, code):
         self._append_stand_source()
         code = self._check_code(code, self._source)
         if code:
             if code[-1] != u';':
                 code += u';'  # eval code MUST be standalone
-            self._source.append(code)
-            return self._eval(code)
+            if self._history is None:
+                self._source.append(code)
+            else:
+                self._history.append(code)
+            return code
 
     exec(get_exec_code(4, """
     @lockmethod
     def call(self, expression, *args, **kwargs):   # py2
-    def call(self, expression, *args, this=None):  # py3
+    def call(self, expression, *args, this=None, timeout=None, memory_limit=None):  # py3
         '''Use expression string and Python arguments to call Javascript function.
         If provided, the keyword argument `this` also be a expression string.
+        The keyword arguments `timeout` and `memory_limit` are same as `eval`.
+        Other keyword arguments will be ignored.   # py2
+        '''
+        this = kwargs.get('this')                  # py2
+        timeout = kwargs.get('timeout')            # py2
+        memory_limit = kwargs.get('memory_limit')  # py2
+        code = self._encode_call(self._call_code, expression, args, this)
+        return self._eval_call(code, timeout, memory_limit)
+
+    @lockmethod
+    def call_many(self, expression, args_list, **kwargs):   # py2
+    def call_many(self, expression, args_list, this=None, timeout=None, memory_limit=None):  # py3
+        '''Same as `call`, but call Javascript function with every arguments in
+        the iterable `args_list` within one evaluation, return a list of results.
+        The error of a single call will be returned as a ProgramError instance.
         Other keyword arguments will be ignored.   # py2
         '''
-        chunks = json_encoder.iterencode(args, _one_shot=True)
+        this = kwargs.get('this')                  # py2
+        timeout = kwargs.get('timeout')            # py2
+        memory_limit = kwargs.get('memory_limit')  # py2
+        code = self._encode_call(self._call_many_code, expression, args_list, this)
+        return self._call_many_results(self._eval_call(code, timeout, memory_limit))
+    """))
+
+    @lockmethod
+    def function(self, expression, this=None):
+        '''Resolve the expression string to a Javascript function once, return
+        a callable JSFunction, its calls skip the resolving. If provided, the
+        argument `this` also be a expression string, it is resolved once too,
+        otherwise the object of a member expression is used, same as `call`.
+        The function is registered as appended code, it will be registered
+        again if the context has been reset. The error of resolving is raised
+        by the calls. The same expression and `this` return the same function.
+        Its calls are not kept in the source, see `clone`.
+        '''
+        handle_key = 'function', to_unicode(expression), this and to_unicode(this)
+        function = self._function_handles.get(handle_key)
+        if function is None:
+            function = JSFunction(self, next(_function_keys), expression, this)
+            self._function_handles[handle_key] = function
+        self._register_function(function)
+        return function
+
+    @lockmethod
+    def compile(self, code):
+        '''Compile Javascript code once, return a Script, it can be ran many
+        times via `Script.run()`, without the parsing. The code runs as the body
+        of a function, so its declarations are local, and the value of its
+        last statement is returned. The syntax error is raised by the runs.
+        The same code returns the same Script. Its runs are not kept in the
+        source, see `clone`.
+        '''
+        handle_key = 'script', to_unicode(code)
+        script = self._function_handles.get(handle_key)
+        if script is not None:
+            self._register_function(script)
+            return script
+        code = self._check_code(code, None) or u''
+        code, expression = split_last_statement(code)
+        if expression:
+            code += u'\nreturn (%s\n)' % expression
+        script = Script(self, next(_function_keys),
+                        u'new Function(%s)' % json_encoder.encode(code))
+        self._function_handles[handle_key] = script
+        self._register_function(script)
+        return script
+
+    def _register_function(self, function):
+        if function.key in self._functions:
+            return
+        expression = to_unicode(function.expression)
+        member = function.this is None and split_member_expression(expression)
+        if member:
+            code = function_bind_script.format(object=member[0], accessor=member[1])
+        else:
+            code = u'({0})'.format(expression)
+        if function.this is not None:
+            code += u'.bind(({0}))'.format(to_unicode(function.this))
+        self.append(function_register_script.format(key=function.key, function=code))
+        self._functions.add(function.key)
+
+    @lockmethod
+    def _call_function(self, function, args, timeout=None, memory_limit=None):
+        # The calls are not kept in the source of any engines, see `clone`
+        self._register_function(function)
+        expression = function_expression % function.key
+        if args:
+            code = self._encode_call(self._call_code, expression, args, None)
+        else:
+            code = u'%s()' % expression
+            self.stats.incr('calls')
+        self._append_stand_source()
+        self._functions_called = True
+        return self._execute(self._eval_expression, code, timeout, memory_limit)
+
+    @lockmethod
+    def _eval_call(self, code, timeout=None, memory_limit=None):
+        # The code generated by `call` is always a single expression
+        return self._execute(self._eval_expression, self._prepare_eval(code),
+                             timeout, memory_limit)
+
+    def _encode_call(self, get_code, expression, args, this):
+        start = timer()
+        code = get_code(expression, args, this)
+        self.stats.add('encode', timer() - start, len(code))
+        self.stats.incr('calls')
+        return code
+
+    def _execute(self, func, code, timeout=None, memory_limit=None):
+        stats = self.stats
+        decoded = stats.decode_time()
+        self._call_limits = timeout, memory_limit
+        start = timer()
+        try:
+            return func(code)
+        except LimitError:
+            stats.incr('errors')
+            self._discard_code(code)
+            raise
+        except Error:
+            stats.incr('errors')
+            raise
+        finally:
+            self._call_limits = None, None
+            # The decoding is recorded by the backend separately
+            elapsed = timer() - start - (stats.decode_time() - decoded)
+            stats.add('execute', elapsed, len(code))
+
+    def _discard_code(self, code):
+        # Don't keep the code which exceeds the limits, it will exceed them
+        # again when the source runs again
+        for source in (self._source, self._history):
+            if source and source[-1] is code:
+                source.pop()
+                break
+
+    @staticmethod
+    def _encode_args(args, encoder=json_encoder):
+        # Return the Javascript code of the arguments, and whether it includes
+        # binary data (memoryview) or not
+        chunks = encoder.iterencode(args, _one_shot=True)
         chunks = [to_unicode(chunk) for chunk in chunks]
         args = u''.join(chunks)
-        this = kwargs.get('this')                  # py2
+        if u'\\u0000jsengine.bytes:' in args:
+            return _sub_bytes(u'_JSEngineBytes("\\1")', args), True
+        return args, False
+
+    @staticmethod
+    def _wrap_bytes_code(code):
+        return bytes_call_script.format(code=code.lstrip(u';'),
+                                        decoder=bytes_decoder_script)
+
+    @classmethod
+    def _call_code(cls, expression, args, this=None):
+        args, has_bytes = cls._encode_args(args)
         if this is None:
             args = args[1:-1]
             code = u'({expression})({args})'
         else:
             this = to_unicode(this)
             code = u'({expression}).apply(({this}), {args})'
-        return self.eval(code.format(**vars()))
-    """))
+        code = code.format(**vars())
+        if has_bytes:
+            code = cls._wrap_bytes_code(code)
+        return code
+
+    @classmethod
+    def _call_many_code(cls, expression, args_list, this=None):
+        args_list = [list(args) for args in args_list]
+        args_list, has_bytes = cls._encode_args(args_list)
+        if this is None:
+            call = u'({expression})(...args)'
+        else:
+            this = to_unicode(this)
+            call = u'({expression}).apply(({this}), args)'
+        call = call.format(**vars())
+        code = call_many_script.format(**vars())
+        if has_bytes:
+            code = cls._wrap_bytes_code(code)
+        return code
+
+    @staticmethod
+    def _call_many_results(results):
+        return [result if ok else ProgramError(result) for ok, result in results]
 
     def _append(self, code):
         pass
 
+    def _reset(self):
+        pass
+
     def _eval(self, code):
         raise NotImplementedError('Method must be implemented by subclass')
+
+    def _eval_expression(self, code):
+        return self._eval(code)
+
+
+_function_keys = count()
+
+class JSFunction(object):
+    '''A callable of a Javascript function which has been resolved in a context,
+    it is created by the context's `function`.
+    '''
+
+    def __init__(self, ctx, key, expression, this=None):
+        self.ctx = ctx
+        self.key = key
+        self.expression = expression
+        self.this = this
+
+    exec(get_exec_code(4, """
+    def __call__(self, *args, **kwargs):   # py2
+    def __call__(self, *args, timeout=None, memory_limit=None):  # py3
+        '''Call the function with Python arguments, the keyword arguments
+        `timeout` and `memory_limit` are same as the context's `eval`.
+        Other keyword arguments will be ignored.   # py2
+        '''
+        timeout = kwargs.get('timeout')            # py2
+        memory_limit = kwargs.get('memory_limit')  # py2
+        return self.ctx._call_function(self, args, timeout, memory_limit)
+    """))
+
+    def __repr__(self):
+        return '<JSFunction %s>' % self.expression
+
+
+class Script(JSFunction):
+    '''A compiled Javascript code, it is created by the context's `compile`.'''
+
+    exec(get_exec_code(4, """
+    def run(self, **kwargs):   # py2
+    def run(self, timeout=None, memory_limit=None):  # py3
+        '''Run the code and return result, the keyword arguments `timeout` and
+        `memory_limit` are same as the context's `eval`.
+        Other keyword arguments will be ignored.   # py2
+        '''
+        timeout = kwargs.get('timeout')            # py2
+        memory_limit = kwargs.get('memory_limit')  # py2
+        return self.ctx._call_function(self, (), timeout, memory_limit)
+    """))
+
+    def __repr__(self):
+        return '<Script %d>' % self.key
+
+
+class OutputIterator(object):
+    '''Iterate over the console output lines of an evaluation.
+
+    The evaluation runs in a thread if the output of the context is live,
+    otherwise the lines are yielded after it has finished. While the thread
+    is running, the context can't be used by the other threads, and it waits
+    when `max_lines` lines have not been consumed. Close the iterator if the
+    iteration is stopped early, the remaining lines are dropped.
+    '''
+
+    _end = object()
+    max_lines = 1024
+
+    def __init__(self, ctx, code):
+        self.result = None
+        self._error = None
+        self._closed = False
+        if ctx.live_output:
+            self._queue = Queue(self.max_lines)
+            self._thread = threading.Thread(target=self._run,
+                            args=(weakref.ref(self), self._queue, ctx, code))
+            self._thread.daemon = True
+            ctx._output_thread = self._thread
+            self._thread.start()
+        else:
+            self._queue = Queue()
+            self._thread = None
+            self._run(None, self._queue, ctx, code)
+
+    @staticmethod
+    def _run(ref, queue, ctx, code):
+        # Don't keep the iterator, it is closed when it is deleted
+        def put(line):
+            while True:
+                if ref is not None:
+                    iterator = ref()
+                    if iterator is None or iterator._closed:
+                        return
+                    del iterator
+                try:
+                    queue.put(line, timeout=0.1)
+                    return
+                except Full:
+                    pass
+
+        on_output, ctx.on_output = ctx.on_output, put
+        result = error = None
+        try:
+            result = ctx.eval(code)
+        except BaseException as e:
+            error = e
+        finally:
+            ctx.on_output = on_output
+            ctx._output_thread = None
+            put((OutputIterator._end, result, error))
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._closed:
+            raise StopIteration
+        line = self._queue.get()
+        if isinstance(line, tuple) and line[0] is self._end:
+            self._closed = True
+            _, self.result, error = line
+            if error is not None:
+                raise error
+            raise StopIteration
+        return line
+
+    next = __next__  # py2
+
+    def close(self):
+        '''Stop the iteration, drop the remaining lines, and wait for the
+        evaluation to finish, then the context can be used again.
+        '''
+        self._closed = True
+        thread = self._thread
+        while thread is not None and thread.is_alive():
+            try:
+                self._queue.get(timeout=0.1)
+            except Empty:
+                pass
+        self._thread = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __del__(self):
+        # The thread drops the remaining lines, don't wait for it
+        self._closed = True
@@ -0,0 +1,193 @@
+'''Asyncio APIs of JSEngine, Python >= 3.5 is required.'''
+
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from subprocess import PIPE
+from jsengine.exceptions import *
+from jsengine.external import ExternalJSEngine, result_fd_args
+from jsengine.stats import timer
+
+
+class AsyncJSEngine(object):
+    '''Asyncio wrapper of a JSEngine context.
+
+    Internal engines work with a dedicated thread per context, the context is
+    also created in that thread, so Chakra's thread affinity is honored.
+    ExternalJSEngine (not persistent) runs its interpreter processes via
+    `asyncio.create_subprocess_exec`, they can be ran concurrently.
+    '''
+
+    def __init__(self, engine_cls=None, *args, **kwargs):
+        '''
+            engine_cls:
+                None means the default JSEngine, or any JSEngine class.
+            (*args, **kwargs):
+                same as the engine_cls.__init__
+        '''
+        if engine_cls is None:
+            import jsengine
+            engine_cls = jsengine.JSEngine
+            if engine_cls is None:
+                jsengine.jsengine()  # raise RuntimeError
+        self.engine_cls = engine_cls
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._context = self._executor.submit(engine_cls, *args, **kwargs)
+
+    async def context(self):
+        '''Return the wrapped JSEngine context.'''
+        return await asyncio.wrap_future(self._context)
+
+    async def _run(self, method, *args):
+        ctx = await self.context()
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self._executor, getattr(ctx, method), *args)
+
+    async def append(self, code):
+        '''Run Javascript code and return none.'''
+        return await self._run('append', code)
+
+    async def eval(self, code, timeout=None, memory_limit=None):
+        '''Run Javascript code and return result. The limits of the context are
+        used if `timeout` or `memory_limit` is None.
+        '''
+        return await self._eval('eval', code, timeout, memory_limit)
+
+    async def _eval(self, method, code, timeout=None, memory_limit=None):
+        ctx = await self.context()
+        if isinstance(ctx, ExternalJSEngine) and not ctx.persistent:
+            # The source will be passed at once, the bookkeeping is cheap
+            code = _locked(ctx, ctx._prepare_eval, code)
+            if code:
+                if timeout is None:
+                    timeout = ctx.timeout
+                if memory_limit is None:
+                    memory_limit = ctx.memory_limit
+                stats = ctx.stats
+                decoded = stats.decode_time()
+                start = timer()
+                try:
+                    return await _eval_external(ctx, code, timeout, memory_limit)
+                except LimitError:
+                    stats.incr('errors')
+                    _locked(ctx, ctx._discard_code, code)
+                    raise
+                except Error:
+                    stats.incr('errors')
+                    raise
+                finally:
+                    elapsed = timer() - start - (stats.decode_time() - decoded)
+                    stats.add('execute', elapsed, len(code))
+        else:
+            return await self._run(method, code, timeout, memory_limit)
+
+    async def call(self, expression, *args, this=None, timeout=None, memory_limit=None):
+        '''Use expression string and Python arguments to call Javascript function.
+        If provided, the keyword argument `this` also be a expression string.
+        The keyword arguments `timeout` and `memory_limit` are same as `eval`.
+        '''
+        ctx = await self.context()
+        code = ctx._encode_call(ctx._call_code, expression, args, this)
+        return await self._eval('_eval_call', code, timeout, memory_limit)
+
+    async def call_many(self, expression, args_list, this=None, timeout=None,
+                        memory_limit=None):
+        '''Same as `call`, but call Javascript function with every arguments in
+        the iterable `args_list` within one evaluation, return a list of results.
+        The error of a single call will be returned as a ProgramError instance.
+        '''
+        ctx = await self.context()
+        code = ctx._encode_call(ctx._call_many_code, expression, args_list, this)
+        return ctx._call_many_results(await self._eval('_eval_call', code, timeout,
+                                                       memory_limit))
+
+    async def reset(self):
+        '''Reset the context to the clean state after its initialization.'''
+        return await self._run('reset')
+
+    async def close(self):
+        '''Release the resources of the context and its thread.'''
+        try:
+            await self._run('close')
+        finally:
+            self._executor.shutdown(wait=False)
+
+    async def __aenter__(self):
+        await self.context()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+
+async def aeval(source):
+    '''Run Javascript code use the default engine asynchronously and return result.'''
+    ctx = AsyncJSEngine()
+    try:
+        return await ctx.eval(source)
+    finally:
+        await ctx.close()
+
+
+async def _communicate(p, input, timeout):
+    # Kill the process when the timeout is up
+    try:
+        return await asyncio.wait_for(p.communicate(input=input), timeout)
+    except asyncio.TimeoutError:
+        try:
+            p.kill()
+        except OSError:
+            pass
+        await p.wait()
+        raise TimeoutError('the evaluation exceeds the timeout: %ss' % timeout)
+
+async def _run_interpreter(ctx, cmd, input=None, timeout=None, memory_limit=None):
+    cmd = ctx._limit_command(cmd, memory_limit)
+    stdin = PIPE if input else None
+    ctx.stats.incr('spawns')
+    if ctx.on_output is not None:
+        # The output is streamed by the threads of OutputReader
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, ctx._run_interpreter_with_output,
+                                          cmd, input, timeout, memory_limit)
+    if not ctx._result_fd:
+        p = await asyncio.create_subprocess_exec(*cmd, stdin=stdin, stdout=PIPE,
+                                                 stderr=PIPE)
+        stdout_data, stderr_data = await _communicate(p, input, timeout)
+        return ctx._check_output(p.returncode, stdout_data, stderr_data, memory_limit)
+
+    # Same as ExternalJSEngine._run_interpreter, the result is read from its fd
+    with result_fd_args(stdin=stdin, stderr=PIPE) as (r, kwargs):
+        p = await asyncio.create_subprocess_exec(*cmd, **kwargs)
+    with os.fdopen(r, 'rb') as reader:
+        frame = asyncio.get_event_loop().run_in_executor(None, reader.read)
+        try:
+            _, stderr_data = await _communicate(p, input, timeout)
+        finally:
+            frame = await frame
+    ctx._check_output(p.returncode, b'', stderr_data, memory_limit)
+    return frame
+
+async def _eval_external(ctx, code, timeout=None, memory_limit=None):
+    # Same as ExternalJSEngine._eval, but the interpreter runs asynchronously
+    commands = ctx._eval_commands(code, memory_limit)
+    try:
+        command = _locked(ctx, next, commands)  # it passes the kept source
+        while isinstance(command, tuple):
+            try:
+                output = await _run_interpreter(ctx, *command, timeout=timeout,
+                                                memory_limit=memory_limit)
+            except RuntimeError as e:
+                command = commands.throw(e)
+            else:
+                command = commands.send(output)
+    finally:
+        commands.close()
+    return command[0]
+
+def _locked(ctx, func, *args):
+    # The bookkeeping of the context runs with its lock, if threading is enabled
+    if ctx._lock is None:
+        return func(*args)
+    with ctx._lock:
+        return func(*args)
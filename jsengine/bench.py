@@ -0,0 +1,323 @@
+'''Benchmarks of JSEngine backends, the results are emitted as JSON.
+
+Usage:
+    python -m jsengine.bench [-e quickjs,chakra,v8,external] [-i node -i qjs]
+                             [-n 50] [-t 4] [-o result.json]
+'''
+
+from __future__ import print_function
+
+import os
+import json
+import time
+import platform
+import threading
+import jsengine
+from jsengine.stats import timer
+from jsengine.internal import V8JSEngine, ChakraJSEngine, QuickJSEngine
+from jsengine.external import (ExternalJSEngine, ExternalInterpreter,
+                               ExternalWorkerOptions)
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+internal_engines = {
+    'quickjs': QuickJSEngine,
+    'chakra': ChakraJSEngine,
+    'v8': V8JSEngine,
+}
+default_payload_sizes = (100, 10000, 1000000)
+default_source_size = 1000000
+
+bench_source = u'''
+function add(a, b) { return a + b }
+function ping(o) { return o }
+'''
+
+
+def get_source(size=default_source_size):
+    '''Return a generated Javascript source which is about `size` characters.'''
+    lines = []
+    length = i = 0
+    while length < size:
+        line = u'function bench%d(a, b) { return a * %d + b }' % (i, i)
+        lines.append(line)
+        length += len(line) + 1
+        i += 1
+    return u'\n'.join(lines)
+
+def get_rss(pid=None):
+    '''Return the resident set size in bytes of the process, or None.'''
+    pid = pid or os.getpid()
+    if psutil:
+        try:
+            return psutil.Process(pid).memory_info().rss
+        except psutil.Error:
+            return
+    try:
+        with open('/proc/%d/statm' % pid) as fp:
+            return int(fp.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, AttributeError):
+        return
+
+def percentiles(times):
+    '''Return the statistics of the times, in milliseconds.'''
+    times = sorted(times)
+    n = len(times)
+    if not n:
+        return
+    ms = lambda t: round(t * 1000, 4)
+    result = dict(('p%d' % p, ms(times[min(n - 1, n * p // 100)]))
+                  for p in (50, 90, 99))
+    result.update(min=ms(times[0]), max=ms(times[-1]), mean=ms(sum(times) / n),
+                  count=n)
+    return result
+
+def measure(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = timer()
+        func()
+        times.append(timer() - start)
+    return times
+
+
+def bench_engine(engine_cls, repeat=50, threads=4, source_size=default_source_size,
+                 payload_sizes=default_payload_sizes, contexts=10, **kwargs):
+    '''Benchmark a JSEngine class, return a dict of the results.
+
+    Params:
+        engine_cls:
+            any JSEngine class.
+        repeat:
+            the number of samples of every measurement.
+        threads:
+            the number of threads used to measure throughput.
+        source_size:
+            the size of the large source which is loaded by a new context.
+        payload_sizes:
+            the sizes of the string payloads used to measure marshalling cost.
+        contexts:
+            the number of contexts used to measure memory.
+        **kwargs:
+            other arguments used for creating the contexts.
+    '''
+    result = {}
+    # Don't keep the evaluated code, one-shot ExternalJSEngine runs the kept
+    # code again in every evaluation, then the latency grows with the calls
+    kwargs.setdefault('history', 0)
+
+    # Creation, the backends will be loaded before the measurement
+    engine_cls(bench_source, **kwargs).close()
+    def create():
+        ctx = engine_cls(bench_source, **kwargs)
+        ctx.eval('0')
+        ctx.close()
+    result['create'] = percentiles(measure(create, max(1, repeat // 5)))
+
+    # Large source loading
+    source = get_source(source_size)
+    def load():
+        ctx = engine_cls(source, **kwargs)
+        ctx.eval('0')
+        ctx.close()
+    result['load'] = percentiles(measure(load, max(1, repeat // 10)))
+    result['load']['source_size'] = len(source)
+    source = None  # release it, `del` is not allowed in py2
+
+    ctx = engine_cls(bench_source, **kwargs)
+    try:
+        ctx.eval('0')
+        result['eval'] = percentiles(measure(lambda: ctx.eval('1 + 1'), repeat))
+        result['call'] = percentiles(measure(lambda: ctx.call('add', 1, 2), repeat))
+
+        # Result marshalling, results to Python and arguments to Javascript
+        result['marshal'] = marshal = {}
+        for size in payload_sizes:
+            payload = u'x' * size
+            code = u'"x".repeat(%d)' % size
+            marshal[str(size)] = {
+                'result': percentiles(measure(lambda: ctx.eval(code), repeat)),
+                'argument': percentiles(measure(lambda: ctx.call('ping', payload),
+                                                repeat)),
+            }
+        result['stats'] = ctx.stats.as_dict()
+    finally:
+        ctx.close()
+
+    result['throughput'] = bench_throughput(engine_cls, repeat, threads, **kwargs)
+    result['memory'] = bench_memory(engine_cls, contexts, **kwargs)
+    return result
+
+def bench_throughput(engine_cls, repeat, threads, **kwargs):
+    '''Return the calls per second when every thread calls with its own context.'''
+    ready = threading.Semaphore(0)
+    start = threading.Event()
+    errors = []
+
+    def run():
+        try:
+            # Create the context in the thread, Chakra has thread affinity
+            ctx = engine_cls(bench_source, **kwargs)
+            ctx.eval('0')
+        except Exception as e:
+            errors.append(e)
+            ready.release()
+            return
+        ready.release()
+        start.wait()
+        try:
+            for _ in range(repeat):
+                ctx.call('add', 1, 2)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            ctx.close()
+
+    workers = [threading.Thread(target=run) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    for _ in workers:
+        ready.acquire()
+    begin = timer()
+    start.set()
+    for worker in workers:
+        worker.join()
+    elapsed = timer() - begin
+    if errors:
+        return {'error': str(errors[0])}
+    return {
+        'threads': threads,
+        'calls': threads * repeat,
+        'calls_per_second': round(threads * repeat / elapsed, 2),
+    }
+
+def bench_memory(engine_cls, contexts, **kwargs):
+    '''Return the memory per context in bytes, measured by RSS.'''
+    external = issubclass(engine_cls, ExternalJSEngine)
+    if external and not kwargs.get('persistent'):
+        return  # no long-lived process
+    before = get_rss()
+    if before is None:
+        return
+    ctxs = []
+    try:
+        for _ in range(contexts):
+            ctx = engine_cls(bench_source, **kwargs)
+            ctx.eval('0')
+            ctxs.append(ctx)
+        used = get_rss() - before
+        if external:
+            for ctx in ctxs:
+                worker = ctx._worker
+                rss = worker and get_rss(worker.process.pid)
+                if rss is None:
+                    return
+                used += rss
+    finally:
+        for ctx in ctxs:
+            ctx.close()
+    return {'contexts': contexts, 'bytes_per_context': used // contexts}
+
+
+def bench(engines=None, interpreters=None, **kwargs):
+    '''Benchmark the backends, return a dict of the results.
+
+    Params:
+        engines:
+            names of the backends, 'quickjs', 'chakra', 'v8', 'external',
+            None means all of them.
+        interpreters:
+            the external interpreters, None means the detected one.
+        **kwargs:
+            same as `bench_engine`.
+    '''
+    if engines is None:
+        engines = list(internal_engines) + ['external']
+    unknown = [name for name in engines
+               if name not in internal_engines and name != 'external']
+    if unknown:
+        raise ValueError('unknown engines: %s, the valid names are: %s'
+                         % (', '.join(unknown),
+                            ', '.join(list(internal_engines) + ['external'])))
+    results = {}
+    for name in engines:
+        if name == 'external':
+            continue
+        try:
+            results[internal_engines[name].__name__] = \
+                    bench_engine(internal_engines[name], **kwargs)
+        except Exception as e:
+            results[internal_engines[name].__name__] = {'error': str(e)}
+
+    if 'external' in engines:
+        if interpreters is None:
+            interpreters = [jsengine._d.external_interpreter]
+        for interpreter in interpreters:
+            if not isinstance(interpreter, ExternalInterpreter):
+                interpreter = interpreter and ExternalInterpreter.get(interpreter)
+            if not interpreter:
+                continue
+            variants = [False]
+            if interpreter.name in ExternalWorkerOptions:
+                variants.append(True)
+            for persistent in variants:
+                name = 'ExternalJSEngine<%s>' % interpreter.name
+                if persistent:
+                    name = 'Persistent' + name
+                try:
+                    results[name] = bench_engine(ExternalJSEngine,
+                                                 interpreter=interpreter,
+                                                 persistent=persistent, **kwargs)
+                except Exception as e:
+                    results[name] = {'error': str(e)}
+
+    return {
+        'jsengine': jsengine.__version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'params': kwargs,
+        'results': results,
+    }
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(prog='python -m jsengine.bench',
+                                     description='Benchmark JSEngine backends.')
+    parser.add_argument('-e', '--engines',
+                        help='comma separated names of the backends, '
+                             'quickjs,chakra,v8,external (default: all)')
+    parser.add_argument('-i', '--interpreter', action='append', dest='interpreters',
+                        help='an external interpreter, can be repeated '
+                             '(default: the detected one)')
+    parser.add_argument('-n', '--repeat', type=int, default=50,
+                        help='the number of samples (default: 50)')
+    parser.add_argument('-t', '--threads', type=int, default=4,
+                        help='the number of threads (default: 4)')
+    parser.add_argument('-s', '--source-size', type=int, default=default_source_size,
+                        help='the size of the large source (default: %d)'
+                             % default_source_size)
+    parser.add_argument('-o', '--output',
+                        help='write the JSON to the file instead of stdout')
+    args = parser.parse_args(argv)
+
+    engines = args.engines and [name.strip().lower()
+                                for name in args.engines.split(',')]
+    try:
+        result = bench(engines, args.interpreters, repeat=args.repeat,
+                       threads=args.threads, source_size=args.source_size)
+    except ValueError as e:
+        parser.error(str(e))
+    output = json.dumps(result, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as fp:
+            fp.write(output)
+    else:
+        print(output)
+
+if __name__ == '__main__':
+    main()
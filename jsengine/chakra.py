@@ -1,3 +1,5 @@
+from jsengine.exceptions import RuntimeError
+from itertools import count
 import threading as _threading
 import os
 import platform
@@ -10,13 +12,24 @@ except ImportError:
 
 threading = False
 chakra_available = False
+# Whether the timeout and memory_limit are supported or not, PyChakra does not
+# expose its runtime
+limits_available = False
+# Whether the scripts can be loaded via their serialized form or not, also
+# PyChakra does not expose it
+serialize_available = False
+
+# Error codes of the execution limits
+JsErrorOutOfMemory = 0x20001
+JsErrorScriptTerminated = 0x30003
 
 if platform.system() == 'Windows':
     from jsengine import chakra_win
-    chakra_available = chakra_win.chakra_available
+    chakra_available = limits_available = chakra_win.chakra_available
+    serialize_available = chakra_win.serialize_available
 
     def _ChakraHandle(threading):
-        chakra_win.threading = threading
+        # Every handle owns its lock
         return chakra_win.ChakraHandle()
 
 # PyChakra
@@ -48,32 +61,148 @@ def ChakraHandle(threading):
         return _ChakraHandle(False)
 
 class ChakraHandleAgent(object):
-    '''A ChakraHandle agent (.eval), every JsContext works with its own thread.
-    Because it can ONLY run with the thread where it has been created.
+    '''A ChakraHandle agent (.eval), every JsContext works with the thread where
+    it has been created. Because it can ONLY run with that thread.
         see https://github.com/chakra-core/ChakraCore/issues/5599
+    The handles are hosted by a bounded pool of threads, see `host_threads`.
     '''
 
     def __init__(self):
+        self.closed = True
+        self.key = next(_agent_keys)
+        self.host = ChakraHost.get()
+        try:
+            self._call('create', ())
+        except BaseException:
+            self.host.release()
+            raise
+        self.closed = False
+
+    def eval(self, script, raw=False, *limits):
+        return self._call('eval', (script, raw) + limits)
+
+    def load(self, script, *limits):
+        return self._call('load', (script,) + limits)
+
+    def _call(self, method, args):
+        if self.closed and method != 'create':
+            raise RuntimeError('the Chakra context has been closed')
+        reply = Reply()
+        self.host.task.put((self.key, method, args, reply))
+        result = reply.get()
+        if isinstance(result, Exception):
+            try:
+                raise result
+            finally:
+                result = None  # break the reference cycle via traceback
+        return result
+
+    def close(self, wait=True):
+        '''Dispose the handle, the pending tasks will be done before that.'''
+        if self.closed:
+            return
+        self.closed = True
+        reply = None
+        if wait and self.host.thread is not _threading.current_thread():
+            reply = Reply()
+        self.host.task.put((self.key, 'close', (), reply))
+        if reply:
+            reply.get()
+
+    def __del__(self):
+        self.close(False)
+
+class Reply(object):
+    '''A reply slot of a task, it is waited by the caller only.'''
+
+    __slots__ = ('lock', 'result')
+
+    def __init__(self):
+        self.lock = _threading.Lock()
+        self.lock.acquire()
+
+    def set(self, result):
+        self.result = result
+        self.lock.release()
+
+    def get(self):
+        self.lock.acquire()
+        result, self.result = self.result, None
+        return result
+
+
+# The maximum number of the threads which host the handles of the agents, and
+# the seconds which an idle thread (hosts none) waits for before it exits
+try:
+    host_threads = os.cpu_count() or 4
+except AttributeError:  # py2
+    import multiprocessing
+    host_threads = multiprocessing.cpu_count()
+host_idle_timeout = 30
+
+_agent_keys = count()
+_hosts = []
+_hosts_lock = _threading.Lock()
+
+class ChakraHost(object):
+    '''A thread which hosts the handles of many agents, it doesn't refer to
+    the agents, it exits when it has been idle for `host_idle_timeout`.
+    '''
+
+    def __init__(self):
+        self.count = 0  # the number of the hosted handles
         self.task = FIFOQueue()
-        self.result = FIFOQueue()
-        _threading._start_new_thread(self.run, ())
+        self.thread = _threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    @classmethod
+    def get(cls):
+        '''Return a host for a new handle, a new thread is started if every
+        thread hosts some handles, and the limit is not exceeded.
+        '''
+        with _hosts_lock:
+            host = min(_hosts, key=lambda host: host.count) if _hosts else None
+            if host is None or host.count and len(_hosts) < host_threads:
+                host = cls()
+                _hosts.append(host)
+            host.count += 1
+            return host
+
+    def release(self):
+        with _hosts_lock:
+            self.count -= 1
 
     def run(self):
-        self.context = _ChakraHandle(True)
+        # Don't keep the raised errors in this frame, their tracebacks refer
+        # to the agents
+        handles = {}
         while True:
-            args = self.task.get()
             try:
-                result = self.context.eval(*args)
+                task = self.task.get(timeout=host_idle_timeout)
+            except queue.Empty:
+                with _hosts_lock:
+                    if self.count == 0 and self.task.empty():
+                        _hosts.remove(self)
+                        return
+                continue
+            key, method, args, reply = task
+            if method == 'close':
+                # The runtime MUST be disposed with its own thread
+                handles.pop(key, None)
+                self.release()
+                if reply:
+                    reply.set(None)
+                continue
+            try:
+                if method == 'create':
+                    # The handle is only used by this thread, so PyChakra's
+                    # global lock is not needed, the hosts run in parallel
+                    handles[key] = _ChakraHandle(False)
+                    result = None
+                else:
+                    result = getattr(handles[key], method)(*args)
             except Exception as e:
-                result = e
-            self.result.put((id(args), result))
-
-    def eval(self, script, raw=False):
-        args = script, raw
-        self.task.put(args)
-        tid, task_id = None, id(args)
-        while tid != task_id:
-            tid, result = self.result.get()
-        if isinstance(result, Exception):
-            raise result
-        return result
+                reply.set(e)
+            else:
+                reply.set(result)
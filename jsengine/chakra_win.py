@@ -3,9 +3,14 @@ Forked from PyChakra (https://github.com/zhengrenzhe/PyChakra) to support
 Windows' built-in Chakra.
 '''
 
+from __future__ import print_function
 
 import ctypes as _ctypes
 import threading as _threading
+import sys
+from collections import OrderedDict
+from itertools import count
+import hashlib
 import json
 
 
@@ -16,65 +21,53 @@ except:
     chakra_available = False
 else:
     chakra_available = True
-    chakra._current_runtime = None
 
+# Whether the scripts can be serialized (parsed once) or not, Windows 10+
+serialize_available = chakra_available and hasattr(chakra, 'JsSerializeScript')
 
-threading = False
-_lock = None
+# The serialized scripts, {content hash: (script buffer, serialized buffer)}.
+# The least recently used ones are evicted when their total bytes exceed
+# `serialized_cache_size`. Chakra reads both buffers lazily during the lifetime
+# of the runtimes which run them, so every handle also keeps the ones it ran.
+serialized_cache_size = 64 * 1024 ** 2
+_serialized_scripts = OrderedDict()
+_serialized_size = 0
+_serialized_lock = _threading.Lock()
 
-def _enable_lock():
-    global _lock
-    if _lock is not None:
-        return
-    _lock = _threading.Lock()
 
-def _disable_lock():
-    global _lock
-    if _lock is None:
-        return
-    try:
-        _lock.release()
-    except:
-        pass
-    _lock = None
+# The key of the current context of every thread, it is set per thread
+_current = _threading.local()
+_handle_keys = count(1)
 
 
 class ChakraHandle(object):
-
-    def _acquire(self):
-        if threading:
-            _enable_lock()
-            _lock.acquire()
-        else:
-            _disable_lock()
-        self.set_current_runtime()
-
-    def _release(self):
-        if threading:
-            try:
-                _lock.release()
-            except:
-                pass
-        else:
-            _disable_lock()
+    '''A Chakra runtime and its context. Every handle owns its lock, so the
+    handles can run in parallel on different threads, but a runtime can ONLY
+    be active on one thread at a time, the agents of `jsengine.chakra` keep
+    every handle on its own thread.
+    '''
 
     def set_current_runtime(self):
-        runtime = id(self)
-        if chakra._current_runtime != runtime:
-            chakra._current_runtime = runtime
+        if getattr(_current, 'key', None) != self.__key:
             chakra.JsSetCurrentContext(self.__context)
+            _current.key = self.__key
 
     def __init__(self):
         # create chakra runtime and context
         runtime = _ctypes.c_void_p()
-        chakra.JsCreateRuntime(0, 0, point(runtime))
+        # 0x2, JsRuntimeAttributeAllowScriptInterrupt, used by timeout
+        chakra.JsCreateRuntime(0x2, 0, point(runtime))
 
         context = _ctypes.c_void_p()
         chakra.JsCreateContext(runtime, point(context))
-        chakra.JsSetCurrentContext(context)
 
         self.__runtime = runtime
         self.__context = context
+        self.__lock = _threading.Lock()
+        self.__key = next(_handle_keys)
+        self.set_current_runtime()
+        self.__memory_limit = None
+        self.__serialized = {}
 
         # get JSON.stringify reference, and create its called arguments array
         stringify = self.eval('JSON.stringify', raw=True)[1]
@@ -87,9 +80,13 @@ class ChakraHandle(object):
         self.__jsonStringifyArgs = args
 
     def __del__(self):
+        if getattr(_current, 'key', None) == self.__key:
+            # The runtime which is active can't be disposed
+            chakra.JsSetCurrentContext(None)
+            _current.key = None
         chakra.JsDisposeRuntime(self.__runtime)
 
-    def eval(self, script, raw=False):
+    def eval(self, script, raw=False, timeout=None, memory_limit=None):
         '''Eval javascript string
 
         Examples:
@@ -100,6 +97,11 @@ class ChakraHandle(object):
             script(str): javascript code string
             raw(bool?): whether return result as chakra JsValueRef directly
                         (optional, default is False)
+            timeout(float?): the maximum seconds of the script running, it
+                        returns JsErrorScriptTerminated when the time is up
+                        (optional, default is None)
+            memory_limit(int?): the maximum bytes of the runtime memory
+                        (optional, default is None)
 
         Returns:
             (bool, result)
@@ -112,15 +114,78 @@ class ChakraHandle(object):
                         chakra internal error code
         '''
 
-        self._acquire()
-
         js_source = _ctypes.c_wchar_p('')
         js_script = _ctypes.c_wchar_p(script)
 
-        result = _ctypes.c_void_p()
-        err = chakra.JsRunScript(js_script, 0, js_source, point(result))
+        def run(result):
+            return chakra.JsRunScript(js_script, 0, js_source, result)
+
+        return self.__run(run, raw, timeout, memory_limit)
+
+    def load(self, script, timeout=None, memory_limit=None):
+        '''Run javascript string via its serialized form, it is serialized at
+        first time, then be reused by all the ChakraHandles, which skip the
+        parsing. Use it for the large library code.
+
+        Parameters:
+            same as eval, without raw
+
+        Returns:
+            same as eval with raw=True
+        '''
+
+        key = hashlib.sha1(script.encode('utf-16-le', 'surrogatepass')).digest()
+        js_source = _ctypes.c_wchar_p('')
+
+        def run(result):
+            cached = self.__serialized.get(key) or _get_serialized(key)
+            if cached is None:
+                js_script = _ctypes.create_unicode_buffer(script)
+                size = _ctypes.c_uint(0)
+                err = chakra.JsSerializeScript(js_script, None, point(size))
+                if err != 0:
+                    return err
+                buffer = (_ctypes.c_ubyte * size.value)()
+                err = chakra.JsSerializeScript(js_script, buffer, point(size))
+                if err != 0:
+                    return err
+                cached = js_script, buffer
+                _set_serialized(key, cached)
+            self.__serialized[key] = cached
+            js_script, buffer = cached
+            return chakra.JsRunSerializedScript(js_script, buffer, 0, js_source, result)
+
+        return self.__run(run, True, timeout, memory_limit)
+
+    def __run(self, run, raw, timeout, memory_limit):
+        with self.__lock:
+            self.set_current_runtime()
+
+            if memory_limit != self.__memory_limit:
+                # -1 means no limit
+                chakra.JsSetRuntimeMemoryLimit(self.__runtime,
+                                               _ctypes.c_size_t(memory_limit or -1))
+                self.__memory_limit = memory_limit
+
+            timer = None
+            if timeout:
+                # It can be called from any thread
+                timer = _threading.Timer(timeout, self.__interrupt)
+                timer.daemon = True
+                timer.start()
+
+            result = _ctypes.c_void_p()
+            try:
+                err = run(point(result))
+            finally:
+                if timer:
+                    timer.cancel()
+                    timer.join()
+                    disabled = _ctypes.c_bool()
+                    chakra.JsIsRuntimeExecutionDisabled(self.__runtime, point(disabled))
+                    if disabled.value:
+                        chakra.JsEnableRuntimeExecution(self.__runtime)
 
-        try:
             # eval success
             if err == 0:
                 if raw:
@@ -130,8 +195,12 @@ class ChakraHandle(object):
 
             return self.__get_error(err)
 
-        finally:
-            self._release()
+    def __interrupt(self):
+        # The running script will return JsErrorScriptTerminated
+        err = chakra.JsDisableRuntimeExecution(self.__runtime)
+        if err != 0:
+            print('Chakra failed to interrupt the script after the timeout, '
+                  'error code: 0x%x' % err, file=sys.stderr)
 
     def __js_value_to_py_value(self, js_value):
         args = self.__jsonStringifyArgs
@@ -178,5 +247,28 @@ class ChakraHandle(object):
         return str_p.value
 
 
+def _get_serialized(key):
+    with _serialized_lock:
+        cached = _serialized_scripts.pop(key, None)
+        if cached is not None:
+            _serialized_scripts[key] = cached  # the most recently used
+        return cached
+
+def _set_serialized(key, cached):
+    global _serialized_size
+    with _serialized_lock:
+        if key in _serialized_scripts:
+            return
+        _serialized_scripts[key] = cached
+        _serialized_size += _serialized_bytes(cached)
+        while _serialized_size > serialized_cache_size and len(_serialized_scripts) > 1:
+            _, evicted = _serialized_scripts.popitem(last=False)
+            _serialized_size -= _serialized_bytes(evicted)
+
+def _serialized_bytes(cached):
+    js_script, buffer = cached
+    return _ctypes.sizeof(js_script) + _ctypes.sizeof(buffer)
+
+
 def point(any):
     return _ctypes.byref(any)
@@ -1,67 +1,193 @@
+'''Detect the available Javascript engines at first use, the result is cached
+on disk, keyed by PATH, its directories and the installed packages.
+'''
+
 from __future__ import print_function
 
+import os
 import sys
+import json
 import platform
-from jsengine.util import which
-
-# PyMiniRacer
-from jsengine.v8 import v8_available
+from jsengine.util import which, get_cache_dir
 
-# PyChakra or Windows built-in Chakra
-from jsengine.chakra import chakra_available
-
-# PyQuickJS
 try:
-    import quickjs
+    from importlib.util import find_spec
 except ImportError:
-    quickjs_available = False
-else:
-    quickjs_available = True
-
-external_interpreter = None
-
-# macOS: built-in JavaScriptCore
-if platform.system() == 'Darwin':
-    # jsc lives on a new path since macOS Catalina
-    jsc_paths = ['/System/Library/Frameworks/JavaScriptCore.framework/Versions/A/Resources/jsc',
-                 '/System/Library/Frameworks/JavaScriptCore.framework/Versions/A/Helpers/jsc']
-    for interpreter in jsc_paths:
-        external_interpreter = which(interpreter)
-        if external_interpreter:
-            break
-
-# Windows: Node.js, QuickJS if installed
-elif platform.system() == 'Windows':
-    for interpreter in ('qjs', 'node', 'nodejs'):
-        external_interpreter = which(interpreter)
-        if external_interpreter:
-            break
-
-    if external_interpreter is None and \
-            not v8_available and \
-            not chakra_available and \
-            not quickjs_available:
+    find_spec = None
+
+
+detected_names = ('quickjs_available', 'chakra_available', 'v8_available',
+                  'external_interpreter')
+package_names = ('quickjs', '_quickjs', 'PyChakra', 'py_mini_racer')
+cache_filename = 'detect.json'
+cache_max_entries = 16
+
+
+def detect(refresh=False):
+    '''Detect the available engines, and set the results as module attributes,
+    which have not been set yet, e.g. by `jsengine.set_external_interpreter`.
+    Set refresh True to ignore the cache.
+    '''
+    key = _get_cache_key()
+    result = not refresh and key and _load_cache(key)
+    if not result:
+        result = _probe()
+        if key:
+            _save_cache(key, result)
+
+    path = result['external_interpreter']
+    if path:
+        from jsengine.external import ExternalInterpreter
+        result['external_interpreter'] = ExternalInterpreter.get(path)
+
+    g = globals()
+    for name in detected_names:
+        g.setdefault(name, result[name])
+    if quickjs_available and 'quickjs' not in g and sys.version_info < (3, 7):
+        import quickjs
+        g['quickjs'] = quickjs
+
+    _print_warning()
+
+if sys.version_info >= (3, 7):
+    def __getattr__(name):
+        if name in detected_names:
+            detect()
+            return globals()[name]
+        if name == 'quickjs':
+            global quickjs
+            import quickjs
+            return quickjs
+        raise AttributeError('module %r has no attribute %r' % (__name__, name))
+
+
+def _probe():
+    # PyMiniRacer
+    from jsengine.v8 import v8_available
+
+    # PyChakra or Windows built-in Chakra
+    from jsengine.chakra import chakra_available
+
+    # PyQuickJS
+    try:
+        global quickjs
+        import quickjs
+    except ImportError:
+        quickjs_available = False
+    else:
+        quickjs_available = True
+
+    external_interpreter = None
+
+    # macOS: built-in JavaScriptCore
+    if platform.system() == 'Darwin':
+        # jsc lives on a new path since macOS Catalina
+        jsc_paths = ['/System/Library/Frameworks/JavaScriptCore.framework/Versions/A/Resources/jsc',
+                     '/System/Library/Frameworks/JavaScriptCore.framework/Versions/A/Helpers/jsc']
+        for interpreter in jsc_paths:
+            external_interpreter = which(interpreter)
+            if external_interpreter:
+                break
+
+    # Windows: Node.js, QuickJS if installed
+    elif platform.system() == 'Windows':
+        for interpreter in ('qjs', 'node', 'nodejs'):
+            external_interpreter = which(interpreter)
+            if external_interpreter:
+                break
+
+    # Linux: Gjs on Gnome, CJS on Cinnamon, or JavaScriptCore, Node.js if installed
+    else:
+        for interpreter in ('gjs', 'cjs', 'jsc', 'qjs', 'nodejs', 'node'):
+            external_interpreter = which(interpreter)
+            if external_interpreter:
+                break
+
+    return {
+        'quickjs_available': quickjs_available,
+        'chakra_available': chakra_available,
+        'v8_available': v8_available,
+        'external_interpreter': external_interpreter,
+    }
+
+def _print_warning():
+    if external_interpreter or v8_available or chakra_available or quickjs_available:
+        return
+
+    if platform.system() == 'Windows':
         print('Please install PyChakra, PyMiniRacer or Node.js!', file=sys.stderr)
 
-# Linux: Gjs on Gnome, CJS on Cinnamon, or JavaScriptCore, Node.js if installed
-else:
-    for interpreter in ('gjs', 'cjs', 'jsc', 'qjs', 'nodejs', 'node'):
-        external_interpreter = which(interpreter)
-        if external_interpreter:
-            break
-
-    if external_interpreter is None and \
-            not v8_available and \
-            not chakra_available and \
-            not quickjs_available:
-        if platform.system() == 'Linux':
-            print('''\
+    elif platform.system() == 'Linux':
+        print('''\
 Please install at least one of the following Javascript interpreter.
 python packages: quickjs, PyChakra, PyMiniRacer
 applications: Gjs, CJS, QuickJS, JavaScriptCore, Node.js.''', file=sys.stderr)
 
-        else:
-            print('''\
+    elif platform.system() != 'Darwin':
+        print('''\
 Sorry, JSEngine is currently not supported officially on your system.
 Please try install one of the following Javascript interpreter.
 applications: Gjs, CJS, QuickJS, JavaScriptCore, Node.js.''', file=sys.stderr)
+
+def _get_cache_key():
+    # The packages are found without importing them
+    if find_spec is None or get_cache_dir() is None:
+        return
+    key = [sys.executable, sys.version, platform.platform(), os.environ.get('PATH')]
+    # An interpreter which is installed into a directory of PATH changes the
+    # modified time of the directory
+    for path in os.environ.get('PATH', '').split(os.pathsep):
+        try:
+            key.append(os.path.getmtime(path))
+        except (OSError, ValueError):
+            key.append(None)
+    for name in package_names:
+        try:
+            spec = find_spec(name)
+        except (ImportError, ValueError):
+            spec = None
+        origin = spec and spec.origin
+        if origin and os.path.exists(origin):
+            key.append([origin, os.path.getmtime(origin)])
+        else:
+            key.append(None)
+    return json.dumps(key)
+
+def _load_cache(key):
+    try:
+        with open(os.path.join(get_cache_dir(), cache_filename)) as fp:
+            result = json.load(fp).get(key)
+    except (IOError, OSError, ValueError, AttributeError):
+        return
+    if not isinstance(result, dict) or set(result) != set(detected_names):
+        return
+    path = result['external_interpreter']
+    if path and not os.access(path, os.X_OK):
+        return  # it has been uninstalled
+    return result
+
+def _save_cache(key, result):
+    cache_dir = get_cache_dir()
+    filename = os.path.join(cache_dir, cache_filename)
+    try:
+        with open(filename) as fp:
+            cache = json.load(fp)
+        if not isinstance(cache, dict) or len(cache) >= cache_max_entries:
+            raise ValueError
+    except (IOError, OSError, ValueError):
+        cache = {}
+    cache[key] = result
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        tmpname = '%s.%d.tmp' % (filename, os.getpid())
+        with open(tmpname, 'w') as fp:
+            json.dump(cache, fp)
+        if hasattr(os, 'replace'):
+            os.replace(tmpname, filename)
+        else:
+            if os.path.exists(filename):
+                os.remove(filename)
+            os.rename(tmpname, filename)
+    except (IOError, OSError):
+        pass
@@ -9,3 +9,13 @@ class RuntimeError(Error):
 # Errors due to JS script
 class ProgramError(Error):
     pass
+
+# Errors due to the execution limits, the context should be recycled
+class LimitError(RuntimeError):
+    pass
+
+class TimeoutError(LimitError):
+    pass
+
+class MemoryLimitError(LimitError):
+    pass
@@ -3,28 +3,58 @@ from __future__ import print_function
 from jsengine.abstract import AbstractJSEngine
 from jsengine.exceptions import *
 from jsengine.util import which, to_bytes, json_encoder, json_encoder_ensure_ascii
+from jsengine.stats import Stats, timer
 from subprocess import Popen, PIPE, list2cmdline
+from contextlib import contextmanager
+from collections import deque
 import jsengine.detect as _d
+import threading
 import tempfile
 import os
 import sys
 import json
+import base64
+
+try:
+    from queue import Queue
+except ImportError:  # py2
+    from Queue import Queue
 
 # The maximum length of command string
 if os.name == 'posix':
     # Used in Unix is ARG_MAX in conf
-    ARG_MAX = int(os.popen('getconf ARG_MAX').read())
+    ARG_MAX = os.sysconf('SC_ARG_MAX')
+    if sys.platform.startswith('linux'):
+        # Linux also limits the length of a single argument (MAX_ARG_STRLEN)
+        ARG_MAX = min(ARG_MAX, 32 * os.sysconf('SC_PAGE_SIZE'))
 else:
     # Used in Windows CreateProcess is 32K
     ARG_MAX = 32 * 1024
 
+# The result can be written to a dedicated file descriptor (see
+# ExternalResultFdOptions), which needs `pass_fds` of POSIX Popen
+try:
+    from subprocess import DEVNULL
+except ImportError:  # py2
+    result_fd_available = False
+else:
+    result_fd_available = os.name == 'posix'
+
 
 class ExternalJSEngine(AbstractJSEngine):
     '''Wrappered for external Javascript interpreter.'''
 
     def __init__(self, source=u'', init_global=False, init_del_gobjects=[],
-                       interpreter=None, **kwargs):
+                       interpreter=None, persistent=False, history=None,
+                       on_output=None, timeout=None, memory_limit=None, **kwargs):
         '''
+            persistent:
+                set True to keep a long-lived interpreter process per context,
+                only the new code will be sent to it. Fallback is False, if
+                the interpreter is not supported, see ExternalWorkerOptions.
+                The process is killed when the timeout is up, the memory limit
+                is passed to it when it is started, a new process will be
+                started if the memory limit is changed.
             (interpreter, **kwargs):
                 same as ExternalInterpreter.__init__
         '''
@@ -43,96 +73,588 @@ class ExternalJSEngine(AbstractJSEngine):
             else:
                 msg += ' Please install one.'
             raise RuntimeError(msg)
+        self._worker = None
+        self._passed_source = 0
+        self._result_fd = (result_fd_available and
+                           self.interpreter.name in ExternalResultFdOptions)
+        self._command = self.interpreter.command
+        if self._result_fd:
+            self._command = self._command + ExternalResultFdOptions[self.interpreter.name][0]
+        self.persistent = persistent and self.interpreter.name in ExternalWorkerOptions
+        if persistent and not self.persistent:
+            print('%r does not support persistent mode, fallback to one by one.'
+                  % self.interpreter, file=sys.stderr)
         # Del 'exports' to ignore import error, e.g. Node.js
         init_del_gobjects = list(init_del_gobjects) + ['exports']
-        AbstractJSEngine.__init__(self, source, init_global, init_del_gobjects)
+        AbstractJSEngine.__init__(self, source, init_global, init_del_gobjects,
+                                  history, on_output, timeout, memory_limit)
 
     __init__.__doc__ = AbstractJSEngine.__init__.__doc__ + __init__.__doc__[9:]
 
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        '''Stop the persistent interpreter process if it is running.'''
+        worker, self._worker = getattr(self, '_worker', None), None
+        if worker:
+            worker.close()
+
+    def _append(self, code):
+        if self.persistent:
+            self._eval_with_worker(code)
+
+    def _append_muted(self, code):
+        if self.persistent:
+            AbstractJSEngine._append_muted(self, code)
+        else:
+            # The passed source is muted when it runs
+            self._passed_source = len(self._source)
+
+    def _reset(self):
+        self.close()
+        self._passed_source = 0
+
+    def _clone(self):
+        # The persistent process will be started at first use, the source is
+        # sent to it at once
+        self._worker = None
+        self._passed_source = 0
+
+    def _discard_code(self, code):
+        AbstractJSEngine._discard_code(self, code)
+        self._passed_source = min(self._passed_source, len(self._source))
+
+    def _eval_with_worker(self, code):
+        timeout, memory_limit = self._get_limits()
+        if self._worker is None or not self._worker.alive or \
+                self._worker.memory_limit != memory_limit:
+            self.close()
+            self.stats.incr('spawns')
+            self._worker = ExternalWorker(self.interpreter, self.stats,
+                                          self._output_callback(), memory_limit)
+            # Replay the kept code, its errors and output have been passed before
+            self._worker.muted = True
+            try:
+                for history in self._source_list(code)[:-1]:
+                    self._worker.eval(history)
+            finally:
+                self._worker.muted = False
+        try:
+            ok, result = self._worker.eval(code, timeout)
+        except LimitError:
+            raise
+        except RuntimeError as e:
+            if memory_limit:
+                raise MemoryLimitError('%s, the memory limit may be exceeded: %d bytes'
+                                       % (e, memory_limit))
+            raise
+        return self._check_result(ok, result, memory_limit)
+
     def _eval(self, code):
-        code = self._inject_script()
+        if self.persistent:
+            return self._eval_with_worker(code)
+
+        commands = self._eval_commands(code, self._get_limits()[1])
+        try:
+            command = next(commands)
+            while isinstance(command, tuple):
+                try:
+                    output = self._run_interpreter(*command)
+                except RuntimeError as e:
+                    command = commands.throw(e)
+                else:
+                    command = commands.send(output)
+        finally:
+            commands.close()
+        return command[0]
+
+    def _eval_commands(self, code, memory_limit=None):
+        # Yield the commands (cmd, input) which run the code, in the order of
+        # the modes (evalstring, pipe, tempfile) and their fallbacks. The output
+        # of every command is sent back, and its RuntimeError is thrown back.
+        # At last, yield the list [result]. It is shared by `_eval` and the
+        # asyncio APIs, which run the commands in their own ways.
+        code = self._inject_script(code)
 
+        interpreter = self.interpreter
+        stats = self.stats
         evalstring = False
-        if self.interpreter.evalstring:
+        if interpreter.evalstring:
             try:
-                output = self._run_interpreter_with_string(code)
-                evalstring = True
+                cmd = self._get_string_command(code)
             except ValueError:
-                pass
-            except RuntimeError:
-                self.interpreter.evalstring = False
+                stats.incr('fallbacks')
+            else:
+                stats.incr('evalstring')
+                try:
+                    output = yield cmd, None
+                    evalstring = True
+                except LimitError:
+                    raise
+                except RuntimeError:
+                    stats.incr('fallbacks')
+                    interpreter.evalstring = False
 
-        if not evalstring and not self.interpreter.tempfile:
+        if not evalstring and not interpreter.tempfile:
+            stats.incr('pipe')
             try:
-                output = self._run_interpreter_with_pipe(code)
+                output = yield self._command, to_bytes(code)
+            except LimitError:
+                raise
             except RuntimeError:
-                self.interpreter.tempfile = True
+                stats.incr('fallbacks')
+                interpreter.tempfile = True
 
         while True:
-            if not evalstring and self.interpreter.tempfile:
-                output = self._run_interpreter_with_tempfile(code)
+            if not evalstring and interpreter.tempfile:
+                stats.incr('tempfile')
+                filename = self._write_tempfile(code)
+                try:
+                    output = yield self._command + [filename], None
+                finally:
+                    os.remove(filename)
 
-            output = output.replace(u'\r\n', u'\n').replace(u'\r', u'\n')
-            # Search result in the last 5 lines of output
-            for result_line in reversed(output.split(u'\n')[-5:]):
-                if result_line[:9] == u'["result"':
-                    break
             try:
-                _, ok, result = json.loads(result_line)
+                result = self._get_result(output, memory_limit)
             except json.decoder.JSONDecodeError as e:
-                if not evalstring and self.interpreter.tempfile:
+                if not evalstring and interpreter.tempfile:
                     raise RuntimeError('%s:\n%s' % (e, output))
                 else:
+                    stats.incr('fallbacks')
                     evalstring = False
-                    self.interpreter.tempfile = True
-                    continue
-            if ok:
-                return result
+                    interpreter.tempfile = True
             else:
-                raise ProgramError(result)
+                yield [result]
+                return
+
+    def _get_result(self, output, memory_limit=None):
+        start = timer()
+        try:
+            if isinstance(output, bytes):
+                # The result frame from the result fd
+                ok, result = load_result(output.decode('utf8'))
+            else:
+                output = output.replace(u'\r\n', u'\n').replace(u'\r', u'\n')
+                # Search result in the last 5 lines of output
+                for result_line in reversed(output.split(u'\n')[-5:]):
+                    if result_line[:9] == u'["result"':
+                        break
+                ok, result = load_result(result_line)
+        finally:
+            self.stats.add('decode', timer() - start, len(output))
+        return self._check_result(ok, result, memory_limit)
+
+    def _check_result(self, ok, result, memory_limit=None):
+        if ok:
+            return result
+        if memory_limit and 'out of memory' in str(result).lower():
+            raise MemoryLimitError('the evaluation exceeds the memory limit: %d bytes'
+                                   % memory_limit)
+        raise ProgramError(result)
 
     def _run_interpreter(self, cmd, input=None):
+        timeout, memory_limit = self._get_limits()
+        cmd = self._limit_command(cmd, memory_limit)
         stdin = PIPE if input else None
-        p = Popen(cmd, stdin=stdin, stdout=PIPE, stderr=PIPE)
-        stdout_data, stderr_data = p.communicate(input=input)
-        if p.returncode != 0:
+        self.stats.incr('spawns')
+        if self.on_output is not None:
+            return self._run_interpreter_with_output(cmd, input, timeout, memory_limit)
+        if not self._result_fd:
+            p = Popen(cmd, stdin=stdin, stdout=PIPE, stderr=PIPE)
+            with ProcessTimer(p, timeout):
+                stdout_data, stderr_data = p.communicate(input=input)
+            return self._check_output(p.returncode, stdout_data, stderr_data,
+                                      memory_limit)
+
+        # Output bytes, the stdout is discarded without buffering
+        p, reader = popen_with_result_fd(cmd, stdin=stdin, stderr=PIPE)
+        with reader, ProcessTimer(p, timeout):
+            frame = []
+            thread = threading.Thread(target=lambda: frame.append(reader.read()))
+            thread.daemon = True
+            thread.start()
+            _, stderr_data = p.communicate(input=input)
+            thread.join()
+        self._check_output(p.returncode, b'', stderr_data, memory_limit)
+        return frame[0]
+
+    def _run_interpreter_with_output(self, cmd, input=None, timeout=None,
+                                     memory_limit=None):
+        # Same as `_run_interpreter`, but the stdout is passed to `on_output`
+        # line by line, while the interpreter is running
+        stdin = PIPE if input else None
+        if self._result_fd:
+            p, reader = popen_with_result_fd(cmd, stdin=stdin, stdout=PIPE, stderr=PIPE)
+        else:
+            p, reader = Popen(cmd, stdin=stdin, stdout=PIPE, stderr=PIPE), None
+        output = OutputReader(p.stdout, self.on_output, not self._result_fd)
+        p.stdout = None  # it is read by the OutputReader, not `communicate`
+        with ProcessTimer(p, timeout):
+            if reader:
+                with reader:
+                    frame = []
+                    thread = threading.Thread(target=lambda: frame.append(reader.read()))
+                    thread.daemon = True
+                    thread.start()
+                    _, stderr_data = p.communicate(input=input)
+                    thread.join()
+            else:
+                _, stderr_data = p.communicate(input=input)
+            output.join()
+        output.raise_error()
+        if reader:
+            self._check_output(p.returncode, b'', stderr_data, memory_limit)
+            return frame[0]
+        # Only the held lines are kept, they include the result line
+        return self._check_output(p.returncode, b'\n'.join(output.held), stderr_data,
+                                  memory_limit)
+
+    def _check_output(self, returncode, stdout_data, stderr_data, memory_limit=None):
+        if returncode != 0:
+            stderr_data = stderr_data.decode('utf8')
+            if memory_limit and 'out of memory' in stderr_data.lower():
+                raise MemoryLimitError('the evaluation exceeds the memory limit: %d bytes'
+                                       % memory_limit)
             raise RuntimeError('%r returns non-zero value! Error msg: %s' %
-                               (_d.external_interpreter, stderr_data.decode('utf8')))
+                               (_d.external_interpreter, stderr_data))
         elif stderr_data:
             print("%r has warnings:" % _d.external_interpreter,
                   stderr_data.decode('utf8'), file=sys.stderr)
         # Output unicode
         return stdout_data.decode('utf8')
 
-    def _run_interpreter_with_string(self, code):
-        cmd = self.interpreter.command + [self.interpreter.evalstring, code]
+    def _limit_command(self, cmd, memory_limit):
+        # Insert the memory limit arguments after the interpreter path
+        if not memory_limit:
+            return cmd
+        args = memory_limit_args(self.interpreter, memory_limit)
+        return cmd[:1] + args + cmd[1:]
+
+    def _get_string_command(self, code):
+        cmd = self._command + [self.interpreter.evalstring, code]
         if len(list2cmdline(cmd)) > ARG_MAX:  # Direct compare, don't wait an Exception
             raise ValueError('code length is too long to run as a command')
-        return self._run_interpreter(cmd)
-
-    def _run_interpreter_with_pipe(self, code):
-        # Input bytes
-        return self._run_interpreter(self.interpreter.command, input=to_bytes(code))
+        return cmd
 
-    def _run_interpreter_with_tempfile(self, code):
+    def _write_tempfile(self, code):
         fd, filename = tempfile.mkstemp(prefix='execjs', suffix='.js')
+        # Write bytes
         try:
-            # Write bytes
-            try:
-                with os.fdopen(fd, 'wb') as fp:
-                    fp.write(to_bytes(code))
-            except BaseException:
-                os.close(fd)
-            return self._run_interpreter(self.interpreter.command + [filename])
-        finally:
+            with os.fdopen(fd, 'wb') as fp:
+                fp.write(to_bytes(code))
+        except BaseException:
             os.remove(filename)
+            raise
+        return filename
 
-    def _inject_script(self):
+    def _inject_script(self, code):
+        # The kept code runs again, the console is muted while the code which
+        # has been ran before is running, its output has been passed
+        kept = self._source_list(code)[:-1]
+        n = len(self._source)
+        passed, self._passed_source = self._passed_source, n
+        source = []
+        for muted, chunks in ((True, kept[:passed]), (False, kept[passed:n]),
+                              (True, kept[n:])):
+            if chunks and muted:
+                source += [u';_JSEngineHelper.mute(true);'] + chunks + \
+                          [u';_JSEngineHelper.mute(false);']
+            else:
+                source += chunks
+        source = u'\n'.join(source + [code])
         if self.interpreter.evalstring:
-            source = json_encoder_ensure_ascii.encode(self.source)
+            source = json_encoder_ensure_ascii.encode(source)
+        else:
+            source = json_encoder.encode(source)
+        if self._result_fd:
+            write = ExternalResultFdOptions[self.interpreter.name][1]
+        else:
+            write = u'_JSEngineHelper.print'
+        return injected_script.format(source=source, write=write)
+
+
+@contextmanager
+def result_fd_args(stdout=None, **kwargs):
+    '''Create a pipe of the result fd, yield (its read end, the arguments of
+    the process), the process MUST be started in the with block, then the
+    write end is closed. Its stdout is discarded by default.
+    '''
+    r, w = os.pipe()
+    try:
+        kwargs.update(stdout=stdout or DEVNULL, pass_fds=(w,),
+                      env=dict(os.environ, JSENGINE_RESULT_FD=str(w)))
+        yield r, kwargs
+    except BaseException:
+        os.close(r)
+        raise
+    finally:
+        os.close(w)
+
+def popen_with_result_fd(cmd, stdout=None, **kwargs):
+    '''Start a process with a pipe of the result fd, its stdout is discarded by
+    default. Return (process, reader of the pipe).
+    '''
+    with result_fd_args(stdout, **kwargs) as (r, kwargs):
+        process = Popen(cmd, **kwargs)
+    return process, os.fdopen(r, 'rb')
+
+
+class ProcessTimer(object):
+    '''Kill the process if it is still running when the timeout is up, use it
+    with the `with` statement, TimeoutError is raised at the exit if it has been
+    killed.
+    '''
+
+    def __init__(self, process, timeout):
+        self.process = process
+        self.timeout = timeout
+        self.expired = False
+        self._timer = None
+
+    def __enter__(self):
+        if self.timeout:
+            self._timer = threading.Timer(self.timeout, self._kill)
+            self._timer.daemon = True
+            self._timer.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._timer:
+            self._timer.cancel()
+            self._timer.join()
+        if self.expired:
+            raise TimeoutError('the evaluation exceeds the timeout: %ss' % self.timeout)
+
+    def _kill(self):
+        if self.process.poll() is None:
+            self.expired = True
+            try:
+                self.process.kill()
+            except OSError:
+                pass
+
+
+def memory_limit_args(interpreter, memory_limit):
+    '''Return the arguments which limit the memory of the interpreter.'''
+    if interpreter.name not in ExternalMemoryLimitOptions:
+        if interpreter.name not in _memory_limit_warned:
+            _memory_limit_warned.add(interpreter.name)
+            print('%r does not support memory_limit, it is ignored.' % interpreter,
+                  file=sys.stderr)
+        return []
+    return [arg.format(bytes=memory_limit, mb=max(1, memory_limit >> 20))
+            for arg in ExternalMemoryLimitOptions[interpreter.name]]
+
+_memory_limit_warned = set()
+
+
+# The end of the output of a worker request, it is written to the stdout
+output_end_marker = b'\x00jsengine:end\n'
+
+
+class OutputReader(threading.Thread):
+    '''Read the stdout of an interpreter process line by line in a thread, and
+    pass the lines to the callback. If the callback raises an error, the rest
+    output is discarded, see `raise_error`.
+    '''
+
+    def __init__(self, stdout, callback, hold_result=False):
+        '''
+        Params:
+            stdout:
+                the binary stdout of the process.
+            callback:
+                it will be called with every decoded line.
+            hold_result:
+                set True if the result is written to the stdout, the result
+                lines and the empty lines before them are held, until a later
+                line is read. The lines which are held at the end are kept in
+                the attribute `held`.
+        '''
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.stdout = stdout
+        self.callback = callback
+        self.hold_result = hold_result
+        self.held = []
+        # The worker writes a marker after every request, see `worker_script`,
+        # a True is put per marker, a False is put at the end
+        self.ends = Queue()
+        self.error = None
+        self.start()
+
+    def run(self):
+        held = self.held
+        try:
+            for line in iter(self.stdout.readline, b''):
+                if line.endswith(output_end_marker):
+                    line = line[:-len(output_end_marker)]
+                    if line:
+                        self.emit(line)
+                    self.ends.put(True)
+                    continue
+                line = line.rstrip(b'\r\n')
+                if self.hold_result:
+                    if not line or line[:9] == b'["result"':
+                        held.append(line)
+                        continue
+                    for held_line in held:
+                        self.emit(held_line)
+                    del held[:]
+                self.emit(line)
+        finally:
+            self.stdout.close()
+            self.ends.put(False)
+
+    def emit(self, line):
+        if self.error is None:
+            try:
+                self.callback(line.decode('utf8', 'replace'))
+            except Exception as e:
+                self.error = e
+
+    def raise_error(self):
+        '''Raise the error of the callback if there is one, then reset it.'''
+        error, self.error = self.error, None
+        if error is not None:
+            raise error
+
+
+class ErrorReader(threading.Thread):
+    '''Read the stderr of an interpreter process in a thread, keep its last
+    lines, they are reported when the process exits unexpectedly.
+    '''
+
+    def __init__(self, stderr, max_lines=20):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.stderr = stderr
+        self.lines = deque(maxlen=max_lines)
+        self.start()
+
+    def run(self):
+        try:
+            for line in iter(self.stderr.readline, b''):
+                self.lines.append(line.rstrip(b'\r\n').decode('utf8', 'replace'))
+        finally:
+            self.stderr.close()
+
+    def tail(self, timeout=1):
+        '''Return the last lines, wait for the end of stderr up to `timeout`.'''
+        self.join(timeout)
+        return u'\n'.join(self.lines)
+
+
+class ExternalWorker(object):
+    '''A long-lived external interpreter process, it reads the code line by line
+    from stdin, and writes the result line to the result fd or stdout.
+    '''
+
+    def __init__(self, interpreter, stats=None, output=None, memory_limit=None):
+        args, io_script = ExternalWorkerOptions[interpreter.name]
+        if memory_limit:
+            args = memory_limit_args(interpreter, memory_limit) + args
+        result_fd = result_fd_available and interpreter.name in ExternalResultFdOptions
+        if result_fd:
+            fd_args, write = ExternalResultFdOptions[interpreter.name]
+            args = args + [arg for arg in fd_args if arg not in args]
+            end = json_encoder.encode(output_end_marker.decode('ascii'))
+        else:
+            write = end = u'null'
+        script = worker_script.format(io=io_script, write=write, end=end)
+        cmd = interpreter.command + args + ['-e', script]
+        self.interpreter = interpreter
+        self.stats = stats or Stats()
+        self.output = output
+        self.memory_limit = memory_limit
+        self.muted = False
+        if result_fd:
+            self.process, self.results = popen_with_result_fd(cmd, stdin=PIPE,
+                                                              stdout=PIPE, stderr=PIPE)
+            self.output_reader = OutputReader(self.process.stdout, self._output)
         else:
-            source = json_encoder.encode(self.source)
-        return injected_script.format(source=source)
+            self.process = Popen(cmd, stdin=PIPE, stdout=PIPE, stderr=PIPE)
+            self.results = self.process.stdout
+            self.output_reader = None
+        # The stderr is drained, its last lines are reported when it exits
+        self.error_reader = ErrorReader(self.process.stderr)
+
+    @property
+    def alive(self):
+        return self.process.poll() is None
+
+    def eval(self, code, timeout=None):
+        '''Send Javascript code and return the result as (ok, result), the
+        process is killed when the timeout is up.
+        '''
+        # One request one line, non-ASCII characters are escaped
+        request = json_encoder_ensure_ascii.encode(code) + '\n'
+        with ProcessTimer(self.process, timeout):
+            line = self._request(request)
+        if self.output_reader:
+            # Wait for the output of this request
+            self.output_reader.ends.get()
+            self.output_reader.raise_error()
+        start = timer()
+        ok, result = load_result(line.decode('utf8'))
+        self.stats.add('decode', timer() - start, len(line))
+        return ok, result
+
+    def _request(self, request):
+        # Send the request, return the result line
+        try:
+            self.process.stdin.write(request.encode('ascii'))
+            self.process.stdin.flush()
+            empty_lines = 0
+            while True:
+                line = self.results.readline()
+                if not line:
+                    raise IOError('result pipe has been closed')
+                if line[:9] == b'["result"':
+                    break
+                if self.output_reader:
+                    continue
+                # The output of the worker without the result fd, the empty
+                # line before the result is not passed
+                line = line.rstrip(b'\r\n')
+                if not line:
+                    empty_lines += 1
+                    continue
+                for _ in range(empty_lines):
+                    self._output(u'')
+                empty_lines = 0
+                self._output(line.decode('utf8', 'replace'))
+        except (IOError, OSError) as e:
+            self.close()
+            raise RuntimeError('%r worker exits unexpectedly: %s, exit code: %s! '
+                               'Error msg: %s' % (self.interpreter, e,
+                               self.process.returncode, self.error_reader.tail()))
+        return line
+
+    def _output(self, line):
+        if self.output is not None and not self.muted:
+            self.output(line)
+
+    def close(self):
+        '''Close stdin to let the worker exit, kill it if it does not.'''
+        process = self.process
+        if process.poll() is None:
+            try:
+                process.stdin.close()
+                process.wait(1)
+            except Exception:
+                process.kill()
+                process.wait()
+        self.results.close()
+
+
+def load_result(line):
+    '''Load the result line, return (ok, result).'''
+    result = json.loads(line)
+    if len(result) > 3 and result[3] == 'bytes':
+        return True, base64.b64decode(result[2])
+    return result[1], result[2]
 
 
 class ExternalInterpreter(object):
@@ -233,9 +755,8 @@ ExternalInterpreterNameAlias = {
          'phantomjs': 'PhantomJS(incompatible)',
 }
 
-# Inject to the script to let it return jsonlized value to python
 # Fixed our helper objects
-injected_script = u'''\
+injected_helper_script = u'''\
 Object.defineProperty((typeof global !== 'undefined') && global ||
                       (typeof globalThis !== 'undefined') && globalThis ||
                       this, '_JSEngineHelper', {{
@@ -253,6 +774,26 @@ Object.defineProperty(_JSEngineHelper, 'print', {{
     writable: false,
     configurable: false
 }})
+Object.defineProperty(_JSEngineHelper, 'mute', {{
+    value: (function() {{
+        var names = ['log', 'info', 'warn', 'error', 'debug', 'trace'],
+            saved = {{}}, noop = function() {{}}
+        return function(muted) {{
+            if (typeof console === 'undefined')
+                return
+            for (var i = 0; i < names.length; i++)
+                try {{
+                    if (muted)
+                        saved[names[i]] = console[names[i]], console[names[i]] = noop
+                    else if (names[i] in saved)
+                        console[names[i]] = saved[names[i]]
+                }}
+                catch (err) {{}}
+        }}
+    }})(),
+    writable: false,
+    configurable: false
+}})
 Object.defineProperty(_JSEngineHelper, 'jsonStringify', {{
     value: JSON.stringify,
     writable: false,
@@ -268,18 +809,168 @@ Object.defineProperty(_JSEngineHelper, 'status', {{
     writable: true,
     configurable: false
 }})
+Object.defineProperty(_JSEngineHelper, 'dumpResult', {{
+    value: function(status, result) {{
+        // Binary data is returned as base64 string, with a type mark
+        var u8 = null
+        if (status && typeof ArrayBuffer !== 'undefined' && result)
+            if (result instanceof ArrayBuffer)
+                u8 = new Uint8Array(result)
+            else if (ArrayBuffer.isView(result))
+                u8 = new Uint8Array(result.buffer, result.byteOffset, result.byteLength)
+        if (u8 === null)
+            return _JSEngineHelper.jsonStringify(["result", status, result])
+        if (typeof Buffer === 'function' && Buffer.from)
+            return _JSEngineHelper.jsonStringify(["result", true,
+                Buffer.from(u8.buffer, u8.byteOffset, u8.length).toString('base64'), "bytes"])
+        var t = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/'
+        var s = [], n = u8.length, i, v
+        for (i = 0; i < n; i += 3) {{
+            v = u8[i] << 16 | (i + 1 < n ? u8[i + 1] << 8 : 0) | (i + 2 < n ? u8[i + 2] : 0)
+            s.push(t[v >> 18 & 63] + t[v >> 12 & 63] +
+                   (i + 1 < n ? t[v >> 6 & 63] : '=') + (i + 2 < n ? t[v & 63] : '='))
+        }}
+        return _JSEngineHelper.jsonStringify(["result", true, s.join(''), "bytes"])
+    }},
+    writable: false,
+    configurable: false
+}})
+'''
+
+# Inject to the script to let it return jsonlized value to python
+injected_script = injected_helper_script + u'''\
 try {{
     _JSEngineHelper.result = eval({source}), _JSEngineHelper.status = true
 }}
 catch (err) {{
+    _JSEngineHelper.mute(false)
     _JSEngineHelper.result = err.toString(), _JSEngineHelper.status = false
 }}
 try {{
-    _JSEngineHelper.print('\\n' + _JSEngineHelper.jsonStringify(
-        ["result", _JSEngineHelper.status, _JSEngineHelper.result]))
+    _JSEngineHelper.result = _JSEngineHelper.dumpResult(
+        _JSEngineHelper.status, _JSEngineHelper.result)
 }}
 catch (err) {{
-    _JSEngineHelper.print(
-        '\\n["result", false, "Script returns a value with an unsupported type"]')
+    _JSEngineHelper.result =
+        '["result", false, "Script returns a value with an unsupported type"]'
 }}
+({write})('\\n' + _JSEngineHelper.result)
+'''
+
+# Run as a long-lived worker, one line request one line result
+worker_script = injected_helper_script + u'''\
+;(function(io, write, end) {{
+    var request
+    write = write || io.write
+    while ((request = io.readline()) !== null) {{
+        if (!request)
+            continue
+        try {{
+            _JSEngineHelper.result = io.evalScript(JSON.parse(request)),
+            _JSEngineHelper.status = true
+        }}
+        catch (err) {{
+            _JSEngineHelper.result = String(err), _JSEngineHelper.status = false
+        }}
+        try {{
+            request = _JSEngineHelper.dumpResult(
+                _JSEngineHelper.status, _JSEngineHelper.result)
+        }}
+        catch (err) {{
+            request = '["result", false, "Script returns a value with an unsupported type"]'
+        }}
+        write('\\n' + request + '\\n')
+        if (end)
+            io.write(end)
+    }}
+}})({io}, {write}, {end})
 '''
+
+# The I/O and global script evaluation of the worker, they are interpreter dependent
+node_worker_io_script = u'''\
+(function() {
+    var fs = require('fs'), vm = require('vm'), buffer = Buffer.alloc(65536),
+        lines = [], rest = ''
+    return {
+        readline: function() {
+            while (!lines.length) {
+                var size
+                try {
+                    size = fs.readSync(0, buffer, 0, buffer.length, null)
+                }
+                catch (err) {
+                    if (err.code === 'EAGAIN')
+                        continue
+                    if (err.code === 'EOF')
+                        return null
+                    throw err
+                }
+                if (size === 0)
+                    return null
+                // Requests are always ASCII
+                lines = (rest + buffer.toString('latin1', 0, size)).split('\\n')
+                rest = lines.pop()
+            }
+            return lines.shift()
+        },
+        write: function(s) {
+            fs.writeSync(1, s)
+        },
+        evalScript: function(code) {
+            return vm.runInThisContext(code)
+        }
+    }
+})()'''
+
+quickjs_worker_io_script = u'''\
+{
+    readline: function() {
+        return std.in.getline()
+    },
+    write: function(s) {
+        std.out.puts(s)
+        std.out.flush()
+    },
+    evalScript: function(code) {
+        return std.evalScript(code)
+    }
+}'''
+
+ExternalWorkerOptions = {
+                # args, io script
+       'Node.js': [        [], node_worker_io_script],
+       'QuickJS': [['--std'], quickjs_worker_io_script],
+}
+
+# Write the result to the file descriptor which number is passed by the
+# environment variable JSENGINE_RESULT_FD, they are interpreter dependent
+node_result_writer_script = u'''\
+(function(s) {
+    var fs = require('fs'), buffer = Buffer.from(s + '\\n'), offset = 0,
+        fd = +process.env.JSENGINE_RESULT_FD
+    while (offset < buffer.length)
+        offset += fs.writeSync(fd, buffer, offset)
+})'''
+
+quickjs_result_writer_script = u'''\
+(function() {
+    var fp = null
+    return function(s) {
+        if (fp === null)
+            fp = std.fdopen(+std.getenv('JSENGINE_RESULT_FD'), 'w')
+        fp.puts(s + '\\n')
+        fp.flush()
+    }
+})()'''
+
+# The arguments which limit the memory, formatted with `bytes` and `mb`
+ExternalMemoryLimitOptions = {
+       'Node.js': ['--max-old-space-size={mb}'],
+       'QuickJS': ['--memory-limit', '{bytes}'],
+}
+
+ExternalResultFdOptions = {
+                # args, writer script
+       'Node.js': [        [], node_result_writer_script],
+       'QuickJS': [['--std'], quickjs_result_writer_script],
+}
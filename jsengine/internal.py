@@ -1,36 +1,136 @@
-from jsengine.abstract import AbstractJSEngine
-from jsengine.chakra import ChakraHandle
-from jsengine.v8 import MiniRacer, esprima
+from __future__ import print_function
+
+from jsengine.abstract import AbstractJSEngine, function_expression
 from jsengine.exceptions import *
+from jsengine.util import lockmethod, json_encoder_strict
+from jsengine.stats import Stats, timer
+from functools import partial
 import jsengine.detect as _d
 import json
+import sys
+
+
+# Binary data is marked as 'bytes', it will be converted without JSON
+quickjs_typeof_script = u'''\
+(obj => ArrayBuffer.isView(obj) || obj instanceof ArrayBuffer ? 'bytes' : typeof obj)
+'''
+
+# Return binary data as a latin-1 string, the binding passes strings as C
+# strings, so NUL is replaced by U+0100
+quickjs_bytes_script = u'''\
+(obj => {
+    var u8 = obj instanceof ArrayBuffer ? new Uint8Array(obj) :
+             new Uint8Array(obj.buffer, obj.byteOffset, obj.byteLength)
+    var chunks = []
+    for (var i = 0; i < u8.length; i += 8192)
+        chunks.push(String.fromCharCode.apply(null, u8.subarray(i, i + 8192)))
+    return chunks.join('').replace(/\\0/g, '\\u0100')
+})
+'''
+
+# Call a function with the JSON of its arguments, without parsing code
+quickjs_apply_script = u'''\
+((f, args) => f(...JSON.parse(args)))
+'''
+
+# Define `console`, the output is passed to `write` line by line
+console_script = u'''\
+;(function(global, write) {{
+    var log = function() {{
+        var lines = Array.prototype.map.call(arguments, String).join(' ').split('\\n')
+        for (var i = 0; i < lines.length; i++)
+            write(lines[i])
+    }}
+    global.console = {{
+        log: log, info: log, warn: log, error: log, debug: log, trace: log
+    }}
+}})(this, {write})
+'''
+
+# The contexts which can not call back to Python buffer the output, while it
+# is enabled
+buffered_output_script = u'''\
+Object.defineProperty(this, '_JSEngineOutput', {
+    value: [],
+    writable: false,
+    configurable: false
+})
+''' + console_script.format(write=u'''\
+function(line) {
+    if (_JSEngineOutput.enabled)
+        _JSEngineOutput.push(line)
+}''')
 
 
 class InternalJSEngine(AbstractJSEngine):
     '''Wrappered for Internal(DLL) Javascript interpreter.'''
 
     def __init__(self, *args, **kwargs):
-        self._context = self.Context()
         AbstractJSEngine.__init__(self, *args, **kwargs)
+        self._reset()
 
     def _append(self, code):
-        self._context.eval(code, eval=False, raw=True)
+        self._run(self._context.eval, code, False, True)
 
     def _eval(self, code):
-        return self._context.eval(code)
+        return self._run(self._context.eval, code)
+
+    def _reset(self):
+        self._context = self.Context(self.stats, self._output_callback())
+
+    def _clone(self):
+        # Don't touch the context of the original
+        self._context = None
+        self._reset()
+
+    def _run(self, func, *args):
+        timeout, memory_limit = self._get_limits()
+        if self.live_output:
+            return func(*args, timeout=timeout, memory_limit=memory_limit)
+        # The output is buffered while `on_output` is set, and passed after
+        # the evaluation
+        context = self._context
+        enabled = self.on_output is not None
+        if enabled is not context.output_enabled:
+            context.enable_output(enabled)
+        if not enabled:
+            return func(*args, timeout=timeout, memory_limit=memory_limit)
+        try:
+            return func(*args, timeout=timeout, memory_limit=memory_limit)
+        finally:
+            for line in context.fetch_output():
+                self.on_output(line)
 
     class Context(object):
-        def __init__(self):
+        def __init__(self, stats=None, output=None):
             raise NotImplementedError('Class `Context` must be implemented by subclass')
 
-        def eval(self, code, eval=True, raw=False):
+        def eval(self, code, eval=True, raw=False, timeout=None, memory_limit=None):
             pass
 
 
+class BufferedOutputContext(object):
+    '''Mixin of the contexts which output is buffered in Javascript.'''
+
+    output_enabled = False
+
+    def init_output(self):
+        self.eval(buffered_output_script, eval=False, raw=True)
+
+    def enable_output(self, enabled):
+        self.eval(u'_JSEngineOutput.enabled = %s' % (enabled and 'true' or 'false'),
+                  eval=False, raw=True)
+        self.output_enabled = enabled
+
+    def fetch_output(self):
+        return self.eval(u'_JSEngineOutput.splice(0)')
+
+
 class V8JSEngine(InternalJSEngine):
     '''Wrappered for V8 python binding PyMiniRacer.'''
 
-    def __init__(self, source=u'', init_global=False, init_del_gobjects=[]):
+    def __init__(self, source=u'', init_global=False, init_del_gobjects=[],
+                       history=None, on_output=None, timeout=None, memory_limit=None):
         if not _d.v8_available:
             msg = ('No supported V8 package found on current python environment!'
                    ' Please install python package PyMiniRacer')
@@ -43,36 +143,26 @@ class V8JSEngine(InternalJSEngine):
             else:
                 msg += '.'
             raise RuntimeError(msg)
-        InternalJSEngine.__init__(self, source, init_global, init_del_gobjects)
+        InternalJSEngine.__init__(self, source, init_global, init_del_gobjects,
+                                  history, on_output, timeout, memory_limit)
 
     __init__.__doc__ = AbstractJSEngine.__init__.__doc__
 
-    # Here is a scope issue now, we MUST execute all codes at once, if there has
-    # no esprima package which use to split source code.
-    # see https://github.com/sqreen/PyMiniRacer/issues/148
-    if not esprima:
-        def _append(self, code):
-            pass
+    live_output = False
 
-        def _eval(self, code):
-            return self._context.eval(self.source)
+    def _eval_expression(self, code):
+        return self._run(self._context.eval, code, True, False, True)
 
-    class Context(object):
-        def __init__(self):
-            if esprima:
-                self._context = MiniRacer()
-        
-        if esprima:
-            @property
-            def context(self):
-                return self._context
-        else:
-            @property
-            def context(self):
-                return MiniRacer()
+    class Context(BufferedOutputContext):
+        def __init__(self, stats=None, output=None):
+            # Load the backend at first use
+            from jsengine.v8 import MiniRacer
+            self._context = MiniRacer(stats)
+            self.init_output()
 
-        def eval(self, code, eval=True, raw=False):
-            ok, result = self.context.eval(code, raw)
+        def eval(self, code, eval=True, raw=False, expression=False,
+                       timeout=None, memory_limit=None):
+            ok, result = self._context.eval(code, raw, expression, timeout, memory_limit)
             if ok:
                 if eval:
                     return result
@@ -83,7 +173,8 @@ class V8JSEngine(InternalJSEngine):
 class ChakraJSEngine(InternalJSEngine):
     '''Wrappered for system's built-in Chakra or PyChakra(ChakraCore).'''
 
-    def __init__(self, source=u'', init_global=False, init_del_gobjects=[]):
+    def __init__(self, source=u'', init_global=False, init_del_gobjects=[],
+                       history=None, on_output=None, timeout=None, memory_limit=None):
         if not _d.chakra_available:
             msg = ('No supported Chakra binary found on your system!'
                    ' Please install python package PyChakra')
@@ -96,27 +187,88 @@ class ChakraJSEngine(InternalJSEngine):
             else:
                 msg += '.'
             raise RuntimeError(msg)
-        InternalJSEngine.__init__(self, source, init_global, init_del_gobjects)
+        InternalJSEngine.__init__(self, source, init_global, init_del_gobjects,
+                                  history, on_output, timeout, memory_limit)
 
     __init__.__doc__ = AbstractJSEngine.__init__.__doc__
 
-    class Context(object):
-        def __init__(self):
-            self._context = ChakraHandle(ChakraJSEngine.threading)
+    live_output = False
+    # The appended code which is larger than this (characters) is loaded via
+    # its serialized form, which is cached and reused by the new contexts
+    serialize_size = 16 * 1024
+
+    def _append(self, code):
+        if len(code) >= self.serialize_size and self._context.serialize_available:
+            self._run(self._context.load, code)
+        else:
+            InternalJSEngine._append(self, code)
+
+    def _reset(self):
+        self.close()
+        InternalJSEngine._reset(self)
+
+    def close(self):
+        '''Release the resources of the context, e.g. its handle on the host thread.'''
+        context = getattr(self, '_context', None)
+        if context is not None:
+            context.close()
 
-        def eval(self, code, eval=True, raw=False):
-            ok, result = self._context.eval(code, raw=raw)
+    class Context(BufferedOutputContext):
+        limits_warned = False
+
+        def __init__(self, stats=None, output=None):
+            # Load the backend at first use, its decoding can't be separated
+            from jsengine import chakra
+            self.chakra = chakra
+            self.serialize_available = chakra.serialize_available
+            self._context = chakra.ChakraHandle(ChakraJSEngine.threading)
+            self.init_output()
+
+        def eval(self, code, eval=True, raw=False, timeout=None, memory_limit=None):
+            chakra = self.chakra
+            if (timeout or memory_limit) and not chakra.limits_available:
+                if not ChakraJSEngine.Context.limits_warned:
+                    ChakraJSEngine.Context.limits_warned = True
+                    print('PyChakra does not support timeout and memory_limit, '
+                          'they are ignored.', file=sys.stderr)
+                timeout = memory_limit = None
+            if timeout or memory_limit:
+                ok, result = self._context.eval(code, raw, timeout, memory_limit)
+            else:
+                ok, result = self._context.eval(code, raw=raw)
+            self.check_result(ok, result, timeout, memory_limit)
+            if eval:
+                return result
+
+        def load(self, code, timeout=None, memory_limit=None):
+            # Windows' built-in Chakra only, see `serialize_available`
+            ok, result = self._context.load(code, timeout, memory_limit)
+            self.check_result(ok, result, timeout, memory_limit)
+
+        def check_result(self, ok, result, timeout, memory_limit):
+            chakra = self.chakra
             if ok:
-                if eval:
-                    return result
+                return
+            if result == chakra.JsErrorScriptTerminated:
+                raise TimeoutError('the evaluation exceeds the timeout: %ss' % timeout)
+            elif memory_limit and (result == chakra.JsErrorOutOfMemory or
+                                   'Out of memory' in str(result)):
+                raise MemoryLimitError('the evaluation exceeds the memory limit: %d bytes'
+                                       % memory_limit)
             else:
                 raise ProgramError(str(result))
 
+        def close(self):
+            close = getattr(self._context, 'close', None)
+            if close is not None:
+                close()
+
 
 class QuickJSEngine(InternalJSEngine):
     '''Wrappered for QuickJS python binding quickjs.'''
 
-    def __init__(self, source=u'', init_global=False, init_del_gobjects=[]):
+    def __init__(self, source=u'', init_global=False, init_del_gobjects=[],
+                       history=None, on_output=None, timeout=None, memory_limit=None):
         if not _d.quickjs_available:
             msg = ('No supported QuickJS package found on current python environment!'
                    ' Please install python package quickjs')
@@ -129,42 +281,134 @@ class QuickJSEngine(InternalJSEngine):
             else:
                 msg += '.'
             raise RuntimeError(msg)
-        InternalJSEngine.__init__(self, source, init_global, init_del_gobjects)
+        InternalJSEngine.__init__(self, source, init_global, init_del_gobjects,
+                                  history, on_output, timeout, memory_limit)
 
     __init__.__doc__ = AbstractJSEngine.__init__.__doc__
 
+    @lockmethod
+    def _call_function(self, function, args, timeout=None, memory_limit=None):
+        # Call the resolved function object directly, the arguments are passed
+        # as JSON, except binary data, NaN and Infinity
+        if args:
+            start = timer()
+            try:
+                code, fallback = self._encode_args(list(args), json_encoder_strict)
+            except ValueError:
+                fallback = True
+            if fallback:
+                return InternalJSEngine._call_function(self, function, args,
+                                                       timeout, memory_limit)
+            self.stats.add('encode', timer() - start, len(code))
+        else:
+            code = u''
+        self.stats.incr('calls')
+        self._register_function(function)
+        self._append_stand_source()
+        self._functions_called = True
+        return self._execute(partial(self._run, self._context.call_function, function.key),
+                             code, timeout, memory_limit)
+
     class Context(object):
-        def __init__(self):
+        Function = None
+
+        def __init__(self, stats=None, output=None):
+            self.stats = stats or Stats()
             self._context = _d.quickjs.Context()
-            self.typeof = self._context.eval(u'(obj => typeof obj)')
-            if hasattr(self, 'Function'):
+            self.limits = None, None
+            if output is not None:
+                # The output is passed while the code is running
+                self._context.add_callable('_JSEngineOutput', output)
+                self._context.eval(console_script.format(write=u'_JSEngineOutput'))
+            self.typeof = self._context.eval(quickjs_typeof_script)
+            self.bytes = self._context.eval(quickjs_bytes_script)
+            self.apply = self._context.eval(quickjs_apply_script)
+            self.functions = {}
+            if not hasattr(_d.quickjs.Context, 'execute_pending_job'):
+                # this is < v1.17.0
+                # It was fixed in v1.16.0, but there is no version string to judge.
+                self.Function = QuickJSFunction
+            if self.Function:
                 self.typeof = self.Function(self.typeof)
+                self.bytes = self.Function(self.bytes)
+                self.apply = self.Function(self.apply)
 
-        def eval(self, code, eval=True, raw=False):
+        def set_limits(self, timeout, memory_limit):
+            if (timeout, memory_limit) != self.limits:
+                self._context.set_time_limit(timeout or -1)
+                self._context.set_memory_limit(memory_limit or -1)
+                self.limits = timeout, memory_limit
+
+        def eval(self, code, eval=True, raw=False, timeout=None, memory_limit=None):
+            self.set_limits(timeout, memory_limit)
             try:
                 result = self._context.eval(code)
             except _d.quickjs.JSException as e:
-                raise ProgramError(*e.args)
+                self.raise_error(e, timeout, memory_limit)
             else:
                 if eval:
-                    if raw or not isinstance(result, _d.quickjs.Object):
-                        return result
-                    elif callable(result) and self.typeof(result) == u'function':
-                        if hasattr(self, 'Function'):
-                            result = self.Function(result)
+                    if raw:
                         return result
-                    else:
-                        return json.loads(result.json())
-
-        if _d.quickjs_available and \
-                not hasattr(_d.quickjs.Context, 'execute_pending_job'):
-            # this is < v1.17.0
-            # It was fixed in v1.16.0, but there is no version string to judge.
-            class Function(object):
-                # https://github.com/PetterS/quickjs/issues/7
-                # Escape StackOverflow when calling function outside
-                def __init__(self, function):
-                    self._function = function
-
-                def __call__(self, *args):
-                    return self._function(*args)
+                    return self.convert(result)
+
+        def call_function(self, key, args, timeout=None, memory_limit=None):
+            function = self.functions.get(key)
+            if function is None:
+                function = self._context.eval(function_expression % key)
+                if self.Function:
+                    function = self.Function(function)
+                self.functions[key] = function
+            self.set_limits(timeout, memory_limit)
+            try:
+                if args or not callable(function):
+                    result = self.apply(function, args or u'[]')
+                else:
+                    result = function()
+            except _d.quickjs.JSException as e:
+                self.raise_error(e, timeout, memory_limit)
+            else:
+                return self.convert(result)
+
+        def raise_error(self, e, timeout, memory_limit):
+            message = e.args and str(e.args[0]) or ''
+            if timeout and message.startswith('InternalError: interrupted'):
+                raise TimeoutError('the evaluation exceeds the timeout: %ss' % timeout)
+            if memory_limit and message.startswith('InternalError: out of memory'):
+                raise MemoryLimitError('the evaluation exceeds the memory limit: %d bytes'
+                                       % memory_limit)
+            raise ProgramError(*e.args)
+
+        def convert(self, result):
+            if not isinstance(result, _d.quickjs.Object):
+                return result
+            typeof = self.typeof(result)
+            if typeof == u'function':
+                if self.Function:
+                    result = self.Function(result)
+                return result
+            start = timer()
+            if typeof == u'bytes':
+                try:
+                    data = self.bytes(result)
+                except _d.quickjs.JSException:
+                    pass  # fallback to JSON, e.g. detached buffer
+                else:
+                    try:
+                        return data.replace(u'\u0100', u'\x00').encode('latin-1')
+                    finally:
+                        self.stats.add('decode', timer() - start, len(data))
+            result = result.json()
+            try:
+                return json.loads(result)
+            finally:
+                self.stats.add('decode', timer() - start, len(result))
+
+
+class QuickJSFunction(object):
+    # https://github.com/PetterS/quickjs/issues/7
+    # Escape StackOverflow when calling function outside
+    def __init__(self, function):
+        self._function = function
+
+    def __call__(self, *args):
+        return self._function(*args)
@@ -0,0 +1,157 @@
+from jsengine.exceptions import *
+from contextlib import contextmanager
+from collections import deque
+import threading
+import time
+
+
+class ContextPool(object):
+    '''A pool of pre-warmed JSEngine contexts which have the same base source.
+
+    Contexts will be used by multiple threads, for ChakraJSEngine, the threading
+    feature MUST be enabled before creating the pool, see `set_threading`.
+    '''
+
+    def __init__(self, engine_cls=None, source=u'', size=4, reset=False, **kwargs):
+        '''Create a pool and pre-warm its contexts.
+
+        Params:
+            engine_cls:
+                None means the default JSEngine, or any JSEngine class,
+                e.g. QuickJSEngine, ChakraJSEngine, V8JSEngine, ExternalJSEngine.
+            source:
+                the base Javascript code of every context.
+            size:
+                the number of contexts.
+            reset:
+                set True to reset the context to its clean post-init state
+                when it has been checked in. A reset rebuilds the context and
+                runs the whole base source again, for a large source it may
+                cost more than the pool saves, reset the global state in
+                Javascript instead, or reset the contexts only when it is
+                required, via `context(reset=True)` or `checkin(ctx, reset=True)`.
+            **kwargs:
+                other arguments used for creating the context,
+                e.g. init_global, interpreter, persistent.
+        '''
+        if engine_cls is None:
+            import jsengine
+            engine_cls = jsengine.JSEngine
+            if engine_cls is None:
+                jsengine.jsengine()  # raise RuntimeError
+        if size < 1:
+            raise ValueError('pool size must be greater than 0')
+        self.engine_cls = engine_cls
+        self.source = source
+        self.size = size
+        self.reset = reset
+        self.kwargs = kwargs
+        self._cond = threading.Condition(threading.Lock())
+        self._idle = deque()
+        self._closed = False
+        self._metrics = dict.fromkeys(('checkouts', 'hits', 'misses', 'resets',
+                                       'discards', 'wait_time', 'max_wait_time'), 0)
+        for _ in range(size):
+            self._idle.append(self._new_context())
+
+    def _new_context(self):
+        ctx = self.engine_cls(self.source, **self.kwargs)
+        # Load the base source now, don't leave it to the first checkout
+        ctx._append_stand_source()
+        return ctx
+
+    def metrics(self):
+        '''Return a dict of the pool metrics, the times are in seconds.'''
+        with self._cond:
+            metrics = self._metrics.copy()
+            metrics['size'] = self.size
+            metrics['idle'] = len(self._idle)
+        return metrics
+
+    def checkout(self, timeout=None):
+        '''Take out an idle context, wait for one if there is none.'''
+        start = time.time()
+        with self._cond:
+            if self._closed:
+                raise RuntimeError('the pool has been closed')
+            hit = bool(self._idle)
+            while not self._idle:
+                remaining = None if timeout is None else start + timeout - time.time()
+                if remaining is not None and remaining <= 0:
+                    raise RuntimeError('no available context in the pool within %ss'
+                                       % timeout)
+                self._cond.wait(remaining)
+                if self._closed:
+                    raise RuntimeError('the pool has been closed')
+            ctx = self._idle.popleft()
+            wait_time = time.time() - start
+            metrics = self._metrics
+            metrics['checkouts'] += 1
+            metrics['hits' if hit else 'misses'] += 1
+            metrics['wait_time'] += wait_time
+            if wait_time > metrics['max_wait_time']:
+                metrics['max_wait_time'] = wait_time
+        return ctx
+
+    def checkin(self, ctx, reset=None):
+        '''Give back a context, reset it if required, the reset runs the base
+        source again.
+        '''
+        if reset is None:
+            reset = self.reset
+        if reset and not self._closed:
+            try:
+                ctx.reset()
+            except Exception:
+                return self.discard(ctx)
+            with self._cond:
+                self._metrics['resets'] += 1
+        self._put(ctx)
+
+    def discard(self, ctx):
+        '''Give back a broken context, a new one will replace it.'''
+        ctx.close()
+        with self._cond:
+            self._metrics['discards'] += 1
+        if not self._closed:
+            self._put(self._new_context())
+
+    def _put(self, ctx):
+        with self._cond:
+            if not self._closed:
+                self._idle.append(ctx)
+                self._cond.notify()
+                return
+        ctx.close()
+
+    @contextmanager
+    def context(self, timeout=None, reset=None):
+        '''Use a context within the `with` statement, the context which raises
+        a JSEngine RuntimeError will be discarded.
+        '''
+        ctx = self.checkout(timeout)
+        try:
+            yield ctx
+        except RuntimeError:
+            self.discard(ctx)
+            raise
+        except BaseException:
+            self.checkin(ctx, reset)
+            raise
+        else:
+            self.checkin(ctx, reset)
+
+    def close(self):
+        '''Close the pool and its idle contexts.'''
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, deque()
+            self._cond.notify_all()
+        for ctx in idle:
+            ctx.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,380 @@
+'''A pool of worker processes which host JSEngine contexts, the Javascript
+workloads use multiple CPU cores, instead of one core per Python process.
+'''
+
+from jsengine.exceptions import *
+from jsengine.util import json_encoder_fallback
+from itertools import count
+import multiprocessing
+import threading
+
+try:
+    import cPickle as pickle  # py2
+except ImportError:
+    import pickle
+
+try:
+    from multiprocessing import shared_memory  # Python >= 3.8
+except ImportError:
+    shared_memory = None
+
+
+# The results which are larger than this (bytes, pickled) are returned via
+# shared memory, instead of the pipe
+shared_memory_threshold = 1 << 20
+
+
+def _pack_args(obj):
+    # memoryview can't be pickled, pass it as the same marked base64 string
+    # which is used to encode it to Javascript
+    if isinstance(obj, memoryview):
+        return json_encoder_fallback(obj)
+    if isinstance(obj, (list, tuple)):
+        return [_pack_args(o) for o in obj]
+    if isinstance(obj, dict):
+        return dict((k, _pack_args(v)) for k, v in obj.items())
+    return obj
+
+def _dumps(ok, result):
+    try:
+        return pickle.dumps((ok, result), pickle.HIGHEST_PROTOCOL)
+    except Exception as e:
+        return pickle.dumps((False, RuntimeError(
+                    'the result can not be passed to the main process: %r' % e)),
+                    pickle.HIGHEST_PROTOCOL)
+
+def _worker_main(conn, engine_cls, source, appended, kwargs, threshold):
+    try:
+        ctx = engine_cls(source, **kwargs)
+        for code in appended:
+            ctx.append(code)
+        ctx._append_stand_source()
+    except Exception as e:
+        conn.send_bytes(_dumps(False, e))
+        return
+    conn.send_bytes(_dumps(True, None))
+    shm = None
+    try:
+        while True:
+            try:
+                request = conn.recv()
+            except EOFError:
+                break
+            if shm is not None:
+                # The last result has been read
+                shm.close()
+                shm = None
+            if request is None:
+                break
+            method, args, kwargs = request
+            try:
+                data = _dumps(True, getattr(ctx, method)(*args, **kwargs))
+            except Exception as e:
+                data = _dumps(False, e)
+            if threshold is not None and len(data) > threshold:
+                # The main process unlinks it, here keeps it opened until the
+                # next request, it is required by Windows
+                shm = shared_memory.SharedMemory(create=True, size=len(data))
+                shm.buf[:len(data)] = data
+                data = _dumps(None, (shm.name, len(data)))
+            conn.send_bytes(data)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if shm is not None:
+            shm.close()
+        ctx.close()
+
+
+class ProcessPoolJSEngine(object):
+    '''A pool of worker processes, every process hosts a JSEngine context which
+    has been loaded the same source.
+
+    The requests are dispatched round-robin, the idle workers are preferred,
+    or by an affinity key, the requests which have the same key are always
+    dispatched to the same worker, so they share the global state.
+    `call_many` without a key shards its arguments across all the workers.
+
+    The arguments and results MUST be picklable, e.g. the functions returned
+    by QuickJSEngine can't be passed. If a worker process exits unexpectedly,
+    a RuntimeError is raised, and it will be restarted with the source and
+    the appended code, but not the evaluated code.
+    '''
+
+    def __init__(self, engine_cls=None, source=u'', processes=None, mp_context=None,
+                       shared_memory_threshold=shared_memory_threshold, **kwargs):
+        '''Create a pool and start its worker processes.
+
+        Params:
+            engine_cls:
+                None means the default JSEngine, or any JSEngine class.
+            source:
+                the base Javascript code of every context.
+            processes:
+                the number of worker processes, default is the CPU count.
+            mp_context:
+                None means the default context of multiprocessing, or a start
+                method name, e.g. 'spawn', or a context.
+            shared_memory_threshold:
+                the results which are larger than it (bytes, pickled) are
+                returned via shared memory, None means always via the pipe,
+                it is always None with Python < 3.8.
+            **kwargs:
+                other arguments used for creating the context, they MUST be
+                picklable, e.g. init_global, interpreter, timeout.
+        '''
+        if engine_cls is None:
+            import jsengine
+            engine_cls = jsengine.JSEngine
+            if engine_cls is None:
+                jsengine.jsengine()  # raise RuntimeError
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        if processes < 1:
+            raise ValueError('processes must be greater than 0')
+        if isinstance(mp_context, str):
+            mp_context = multiprocessing.get_context(mp_context)
+        elif mp_context is None:
+            mp_context = multiprocessing
+        self.engine_cls = engine_cls
+        self.source = source
+        self.processes = processes
+        self.kwargs = kwargs
+        self._mp_context = mp_context
+        if shared_memory is None:
+            shared_memory_threshold = None
+        self._threshold = shared_memory_threshold
+        if shared_memory_threshold is not None:
+            try:
+                # The workers share the tracker, so the unlinked memory is
+                # not reported as leaked
+                from multiprocessing import resource_tracker
+                resource_tracker.ensure_running()
+            except (ImportError, AttributeError):
+                pass
+        self._appended = []
+        self._lock = threading.Lock()
+        self._counter = count()
+        self._closed = False
+        self._workers = []
+        try:
+            for _ in range(processes):
+                self._workers.append(_Worker(self))
+            for worker in self._workers:
+                worker.ready()
+        except BaseException:
+            self.close()
+            raise
+
+    def _select(self, key=None):
+        workers = self._workers
+        if key is not None:
+            return workers[hash(key) % len(workers)]
+        start = next(self._counter)
+        for i in range(len(workers)):
+            worker = workers[(start + i) % len(workers)]
+            if not worker.lock.locked():
+                return worker
+        return workers[start % len(workers)]
+
+    def _check_closed(self):
+        if self._closed:
+            raise RuntimeError('the pool has been closed')
+
+    def _request(self, key, method, *args, **kwargs):
+        self._check_closed()
+        return self._select(key).request(method, args, kwargs)
+
+    def _broadcast(self, method, *args):
+        # Send to all the workers, then receive the results, the workers run
+        # at the same time. The locks are always acquired in the same order.
+        self._check_closed()
+        workers = self._workers
+        for worker in workers:
+            worker.lock.acquire()
+        try:
+            errors = [worker.send(method, args, {}) for worker in workers]
+            results = [error or worker.receive()
+                       for worker, error in zip(workers, errors)]
+        finally:
+            for worker in workers:
+                worker.lock.release()
+        return _raise_first(results)
+
+    def append(self, code):
+        '''Run Javascript code in every worker and return none.'''
+        with self._lock:
+            self._broadcast('append', code)
+            self._appended.append(code)
+
+    def eval(self, code, key=None, timeout=None, memory_limit=None):
+        '''Run Javascript code in a worker and return result.
+
+        Params:
+            key:
+                the affinity key, any hashable object.
+            timeout, memory_limit:
+                same as the context's `eval`.
+        '''
+        return self._request(key, 'eval', code, timeout, memory_limit)
+
+    def call(self, expression, *args, **kwargs):
+        '''Use expression string and Python arguments to call Javascript
+        function in a worker. The keyword arguments are `key` and the same as
+        the context's `call`.
+        '''
+        key = kwargs.pop('key', None)
+        return self._request(key, 'call', expression, *_pack_args(args), **kwargs)
+
+    def call_many(self, expression, args_list, key=None, **kwargs):
+        '''Same as the context's `call_many`, the arguments are sharded across
+        all the workers, unless the affinity key is provided.
+        '''
+        args_list = _pack_args(list(args_list))
+        if key is not None or len(self._workers) == 1 or len(args_list) < 2:
+            return self._request(key, 'call_many', expression, args_list, **kwargs)
+        self._check_closed()
+        workers = self._workers[:len(args_list)]
+        size, extra = divmod(len(args_list), len(workers))
+        shards = []
+        start = 0
+        for i in range(len(workers)):
+            end = start + size + (i < extra)
+            shards.append(args_list[start:end])
+            start = end
+        for worker in workers:
+            worker.lock.acquire()
+        try:
+            errors = [worker.send('call_many', (expression, shard), kwargs)
+                      for worker, shard in zip(workers, shards)]
+            results = [error or worker.receive()
+                       for worker, error in zip(workers, errors)]
+        finally:
+            for worker in workers:
+                worker.lock.release()
+        return [result for shard in _raise_first(results) for result in shard]
+
+    def reset(self):
+        '''Reset every context to the clean state after the pool creation,
+        the appended code is also removed.
+        '''
+        with self._lock:
+            self._broadcast('reset')
+            self._appended = []
+
+    def close(self):
+        '''Stop all the worker processes.'''
+        self._closed = True
+        for worker in self._workers:
+            worker.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+def _raise_first(results):
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    return results
+
+
+class _Worker(object):
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.lock = threading.Lock()
+        self._start()
+
+    def _start(self):
+        pool = self.pool
+        self.conn, conn = pool._mp_context.Pipe()
+        self.process = pool._mp_context.Process(
+                target=_worker_main,
+                args=(conn, pool.engine_cls, pool.source, list(pool._appended),
+                      pool.kwargs, pool._threshold))
+        self.process.daemon = True
+        self.process.start()
+        conn.close()
+        self.started = False
+        self.broken = False
+
+    def ready(self):
+        if not self.started:
+            self.started = True
+            result = self.receive()
+            if isinstance(result, BaseException):
+                raise result
+
+    def request(self, method, args, kwargs):
+        with self.lock:
+            result = self.send(method, args, kwargs) or self.receive()
+        if isinstance(result, BaseException):
+            raise result
+        return result
+
+    def send(self, method, args, kwargs):
+        # Return None, or the error
+        try:
+            if self.broken or self.process.exitcode is not None:
+                self.close()
+                self._start()
+            self.ready()
+        except Exception as e:
+            self.broken = True
+            return e
+        try:
+            self.conn.send((method, args, kwargs))
+        except (EOFError, OSError) as e:
+            self.broken = True
+            return RuntimeError('the worker process has exited unexpectedly: %r' % e)
+        except Exception as e:
+            return e  # pickling error
+
+    def receive(self):
+        # Return the result, or the error
+        try:
+            data = self.conn.recv_bytes()
+        except (EOFError, OSError):
+            self.broken = True
+            self.process.join(1)
+            return RuntimeError('the worker process has exited unexpectedly, '
+                                'exit code: %s' % self.process.exitcode)
+        ok, result = pickle.loads(data)
+        if ok is None:
+            name, size = result
+            shm = shared_memory.SharedMemory(name)
+            try:
+                buf = shm.buf[:size]
+                try:
+                    ok, result = pickle.loads(buf)
+                finally:
+                    buf.release()
+            finally:
+                shm.close()
+                shm.unlink()
+        if ok:
+            return result
+        if not isinstance(result, BaseException):
+            result = RuntimeError(result)
+        return result
+
+    def close(self):
+        try:
+            self.conn.send(None)
+        except (EOFError, OSError, ValueError):
+            pass
+        self.conn.close()
+        self.process.join(1)
+        if self.process.exitcode is None:
+            self.process.terminate()
+            self.process.join()
@@ -0,0 +1,76 @@
+import time
+
+
+timer = getattr(time, 'perf_counter', time.time)
+
+
+class Stats(object):
+    '''Timings and counters of a JSEngine context, they are cheap enough to be
+    always enabled.
+
+    Phases, every phase records its total time (seconds), count, and the total
+    size of the processed text (characters):
+        check_code:
+            check and convert the inputted code.
+        encode:
+            encode the Python arguments of `call/call_many` to Javascript.
+        flush:
+            run the appended code, before the next evaluation.
+        execute:
+            run the evaluated code, without its decoding.
+        decode:
+            decode the result to Python, it is a part of execute phase with
+            ChakraJSEngine.
+
+    Counters:
+        calls, errors (ProgramError and RuntimeError),
+        ExternalJSEngine only: spawns (interpreter processes), evalstring,
+        pipe, tempfile (the ways used to pass the code), fallbacks (from a way
+        to another).
+    '''
+
+    phases = ('check_code', 'encode', 'flush', 'execute', 'decode')
+    counter_names = ('calls', 'errors', 'spawns',
+                     'evalstring', 'pipe', 'tempfile', 'fallbacks')
+
+    def __init__(self):
+        # Callables which will be called with (phase, seconds, size)
+        self.hooks = []
+        self.clear()
+
+    def clear(self):
+        '''Clear all the timings and counters.'''
+        # phase: [time, count, size]
+        self._phases = dict((phase, [0.0, 0, 0]) for phase in self.phases)
+        self.counters = dict.fromkeys(self.counter_names, 0)
+
+    def add(self, phase, seconds, size=0):
+        '''Record a run of the phase.'''
+        v = self._phases[phase]
+        v[0] += seconds
+        v[1] += 1
+        v[2] += size
+        if self.hooks:
+            for hook in self.hooks:
+                hook(phase, seconds, size)
+
+    def decode_time(self):
+        '''Return the total time of decode phase.'''
+        return self._phases['decode'][0]
+
+    def incr(self, name, n=1):
+        '''Increase the counter.'''
+        self.counters[name] += n
+
+    def as_dict(self):
+        '''Return a snapshot of the stats as a dict.'''
+        return {
+            'phases': dict((phase, {'time': v[0], 'count': v[1], 'size': v[2]})
+                           for phase, v in self._phases.items()),
+            'counters': dict(self.counters),
+        }
+
+    def __repr__(self):
+        return '<Stats %s>' % ', '.join('%s=%d/%.6fs' % (phase, self._phases[phase][1],
+                                                        self._phases[phase][0])
+                                        for phase in self.phases)
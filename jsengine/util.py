@@ -1,7 +1,11 @@
+from jsengine.exceptions import RuntimeError
 import os
+import re
 import sys
 import json
+import base64
 import locale
+import threading
 from functools import wraps
 
 try:
@@ -43,9 +47,14 @@ def to_bytes(s):
         s = s.encode('utf8')
     return s
 
+# memoryview is binary data, it is encoded as a marked base64 string
+bytes_marker = u'\x00jsengine.bytes:'
+
 def json_encoder_fallback(o):
     if isinstance(o, (bytes, bytearray)):
         return to_unicode(o)
+    if isinstance(o, memoryview):
+        return bytes_marker + base64.b64encode(o.tobytes()).decode('ascii')
     return json.JSONEncoder.default(json_encoder, o)
 
 json_encoder = json.JSONEncoder(
@@ -58,6 +67,17 @@ json_encoder = json.JSONEncoder(
     default=json_encoder_fallback,
 )
 
+# Raise ValueError for NaN and Infinity, they are not valid JSON
+json_encoder_strict = json.JSONEncoder(
+    skipkeys=True,
+    ensure_ascii=False,
+    check_circular=True,
+    allow_nan=False,
+    indent=None,
+    separators=None,
+    default=json_encoder_fallback,
+)
+
 json_encoder_ensure_ascii = json.JSONEncoder(
     skipkeys=True,
     ensure_ascii=True,
@@ -68,9 +88,28 @@ json_encoder_ensure_ascii = json.JSONEncoder(
     default=None,
 )
 
+def get_cache_dir():
+    '''Return the cache directory of JSEngine, it can be set by the environment
+    variable JSENGINE_CACHE_DIR, set it to empty to disable the caches.
+    '''
+    path = os.environ.get('JSENGINE_CACHE_DIR')
+    if path is not None:
+        return path or None
+    if os.name == 'nt':
+        path = os.environ.get('LOCALAPPDATA') or os.path.expanduser('~')
+    elif sys.platform == 'darwin':
+        path = os.path.expanduser('~/Library/Caches')
+    else:
+        path = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(path, 'jsengine')
+
 def lockmethod(func):
     @wraps(func)
     def newfunc(self, *args, **kwargs):
+        output_thread = self._output_thread
+        if output_thread is not None and output_thread is not threading.current_thread():
+            raise RuntimeError('the context is running an output iterator, '
+                               'finish or close it before using the context')
         if self._lock is None:
             return func(self, *args, **kwargs)
         self._lock.acquire()
@@ -88,3 +127,213 @@ def get_exec_code(indent, code, py2=sys.version_info<(3,)):
             continue
         lines.append(line[indent:])
     return '\n'.join(lines)
+
+# A lightweight Javascript tokenizer, it is used to find the last top-level
+# statement of the source code, if there is no Esprima.
+_js_tokenize = re.compile(r'''
+    (?P<newline>[\r\n]) |
+    (?P<space>[^\S\r\n]+) |
+    (?P<comment>//[^\r\n]*|/\*[\s\S]*?\*/) |
+    (?P<string>"(?:\\[\s\S]|[^"\\\r\n])*"|'(?:\\[\s\S]|[^'\\\r\n])*') |
+    (?P<template>`) |
+    (?P<number>\.?\d[\w.]*) |
+    (?P<word>[\w$]+) |
+    (?P<punct>=>|\+\+|--|[^\s\w$])
+''', re.UNICODE | re.VERBOSE).match
+_js_template = re.compile(r'(?:\\[\s\S]|\$(?!\{)|[^`\\$])*(`|\$\{)').match
+_js_regex = re.compile(r'/(?:\\.|\[(?:\\.|[^\]\\\r\n])*\]|[^/\\\r\n\[])+/[\w$]*',
+                       re.UNICODE).match
+
+# Statements which are not ExpressionStatement
+_js_statement_words = frozenset('''
+    var let const function class if for while do switch try return throw break
+    continue import export else catch finally with debugger
+'''.split())
+# The end of these statements is a block
+_js_block_words = frozenset('''
+    function class if for while switch try else catch finally with
+'''.split())
+# The header `(...)` of these statements is followed by a body
+_js_header_words = frozenset('if for while with'.split())
+# A regex literal can follow these words, and they can not end a statement
+_js_operator_words = frozenset('''
+    typeof instanceof in of new delete void throw case do else return yield
+    await extends var let const
+'''.split())
+# These tokens at the start of a line continue the previous expression
+_js_continue_puncts = frozenset('([.,?:+-*/%=<>&|^`')
+_js_continue_words = frozenset(('in', 'instanceof'))
+_js_end_puncts = frozenset((')', ']', '}', '++', '--'))
+
+def split_last_statement(code):
+    '''Split the code into the leading code and the expression of the last
+    top-level statement, the expression is empty if the last statement is not
+    an ExpressionStatement or the code can not be tokenized.
+    '''
+    pos, end = 0, len(code)
+    stack = []            # opened brackets and templates
+    prev = None           # (kind, value) of the last significant token
+    newline = False       # there is a newline after the last token
+    start = None          # the start of current top-level statement
+    first = None          # the first two words of current top-level statement
+    header = False        # in `if (...)` etc. header
+    last_start = last_end = prev_end = None
+    while pos < end:
+        if prev == ('punct', '`'):
+            # continue the template after backtick or placeholder `}`
+            m = _js_template(code, pos)
+            if not m:
+                return code, u''
+            pos = m.end()
+            if m.group(1) == '`':
+                prev = 'string', '`'
+                prev_end = pos
+            else:
+                stack.append('`')
+                prev = 'punct', '${'
+            continue
+        m = _js_tokenize(code, pos)
+        kind = m.lastgroup
+        value = m.group()
+        if kind == 'comment':
+            if '\n' in value or '\r' in value:
+                kind = 'newline'
+            else:
+                kind = 'space'
+        if kind == 'newline':
+            newline = True
+        if kind in ('newline', 'space'):
+            pos = m.end()
+            continue
+        if kind == 'punct' and value == '/' and (prev is None or
+                prev[0] == 'punct' and prev[1] not in _js_end_puncts or
+                prev[0] == 'word' and prev[1] in _js_operator_words):
+            m = _js_regex(code, pos)
+            if not m:
+                return code, u''
+            kind = 'regex'
+            value = m.group()
+
+        if not stack:
+            # Automatic semicolon insertion, roughly
+            if (newline and start is not None and not header and
+                    (prev[0] != 'punct' or prev[1] in _js_end_puncts) and
+                    (prev[0] != 'word' or prev[1] not in _js_operator_words) and
+                    not (kind == 'punct' and value[0] in _js_continue_puncts and
+                         value not in ('++', '--') or
+                         kind == 'word' and value in _js_continue_words or
+                         kind == 'template')):  # a tagged template
+                last_start, last_end = start, prev_end
+                start = None
+            if start is None:
+                start, first = pos, []
+            if len(first) < 2:
+                first.append(value)
+            header = False
+
+        pos = m.end()
+        newline = False
+        if kind == 'template':
+            prev = 'punct', '`'
+            continue
+        prev = kind, value
+        prev_end = pos
+        if kind != 'punct':
+            continue
+        if value in '([{':
+            stack.append(value)
+        elif value in ')]}':
+            if not stack:
+                return code, u''
+            opened = stack.pop()
+            if opened == '`' and value == '}':
+                prev = 'punct', '`'
+            elif opened != {')': '(', ']': '[', '}': '{'}[value]:
+                return code, u''
+            elif not stack:
+                if value == ')' and first[0] in _js_header_words:
+                    header = True
+                elif value == '}' and (first[0] == '{' or
+                                       first[0] in _js_block_words or
+                                       first == ['async', 'function']):
+                    last_start, last_end = start, pos
+                    start = None
+        elif value == ';' and not stack:
+            if start < prev_end - 1:  # not an empty statement
+                last_start, last_end = start, pos
+            start = None
+
+    if stack or prev == ('punct', '`'):
+        return code, u''
+    if start is not None:
+        last_start, last_end = start, prev_end
+    if last_start is None:
+        return code, u''
+    statement = code[last_start:last_end]
+    m = _js_tokenize(statement)
+    word = m.group()
+    if word == '{' or word in _js_statement_words or \
+            word == 'async' and re.match(r'async\s+function\b', statement):
+        return code, u''
+    if m.lastgroup == 'word':
+        # A labelled statement, `label: ...`
+        m = _js_tokenize(statement, m.end())
+        while m and m.lastgroup in ('newline', 'space', 'comment'):
+            m = _js_tokenize(statement, m.end())
+        if m and m.group() == ':':
+            return code, u''
+    return code[:last_start], statement.rstrip(u'; \t')
+
+def split_member_expression(expression):
+    '''Split a member expression into its object and the last property
+    accessor, e.g. `a.b[c].d` -> (`a.b[c]`, `.d`), return None if it is not a
+    member expression or it can not be tokenized.
+    '''
+    pos, end = 0, len(expression)
+    depth = 0
+    prev = None           # the last significant top-level token
+    last = None           # the start of the last top-level accessor
+    last_end = None       # the end of the last significant token
+    while pos < end:
+        m = _js_tokenize(expression, pos)
+        kind = m.lastgroup
+        value = m.group()
+        pos = m.end()
+        if kind in ('newline', 'space', 'comment'):
+            continue
+        last_end = pos
+        if kind == 'template':
+            return
+        if not depth:
+            if kind == 'punct':
+                if value == '.' and prev is not None and prev != '.':
+                    last = m.start()
+                elif value == '[' and prev is not None and prev != '.':
+                    last = m.start()
+                elif value == '(' and prev is not None and prev != '.':
+                    last = None  # a call
+                else:
+                    return
+            elif kind == 'word':
+                if prev not in (None, '.') or \
+                        value in _js_statement_words or value in _js_operator_words:
+                    return
+            elif kind in ('number', 'string'):
+                if prev is not None:
+                    return
+            else:
+                return
+            prev = value if kind == 'punct' else kind
+        if kind == 'punct':
+            if value in '([{':
+                depth += 1
+            elif value in ')]}':
+                depth -= 1
+                if depth < 0:
+                    return
+                if not depth:
+                    prev = value
+    if depth or prev in (None, '.', ')') or last is None:
+        return
+    return expression[:last], expression[last:last_end]
+
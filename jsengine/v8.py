@@ -1,9 +1,16 @@
-from __future__ import print_function
-
 import os
+import re
 import json
 import ctypes
-from jsengine.util import to_bytes
+from jsengine.exceptions import TimeoutError, MemoryLimitError
+from jsengine.util import to_bytes, split_last_statement
+from jsengine.stats import Stats, timer
+
+try:
+    from functools import lru_cache
+except ImportError:  # py2
+    def lru_cache(maxsize):
+        return lambda func: func
 
 try:
     from py_mini_racer import py_mini_racer
@@ -15,10 +22,17 @@ else:
     v8_available = True
 
 v8 = None
+split_cache_size = 128
 
+_strip_ending = re.compile(r'[\s;]*$', re.UNICODE).sub
+_strip_starting = re.compile(r'^[\s;]*', re.UNICODE).sub
+
+# Binary data is returned as ArrayBuffer, it will be converted without JSON
 injected_script = u'''\
 {code}
-JSON.stringify([({expression})])
+;(r => ArrayBuffer.isView(r) ?
+          new Uint8Array(r.buffer, r.byteOffset, r.byteLength).slice().buffer :
+      r instanceof ArrayBuffer ? r : JSON.stringify([r]))(({expression}))
 '''
 
 try:
@@ -26,27 +40,17 @@ try:
     if v8_available:
         from esprima.parser import Parser
 except ImportError:
-    esprima = warned = False
-
-    def split_last_expr(code):
-        global warned
-        if not warned:
-            import sys
-            print('There is a scope issue with class declarations in PyMiniRacer,'
-                  ' measures to relieve it result in degrade performance!'
-                  ' Please install esprima to resolve the issue.',
-                  file=sys.stderr)
-            warned = True
-        return u'', u'eval(%r)' % code
+    esprima = False
+
+    # Without Esprima, use a lightweight tokenizer to find the last statement
+    split_last_expr = lru_cache(split_cache_size)(split_last_statement)
 else:
     if v8_available:
 
-        import re
-        _strip_ending = re.compile('[\s;]*$', re.UNICODE).sub
-
-        def split_last_expr(code, options={'range': True}):
+        @lru_cache(split_cache_size)
+        def split_last_expr(code):
             try:
-                nodes = Parser(code, options=options).parseScript().body
+                nodes = Parser(code, options={'range': True}).parseScript().body
             except Exception:
                 return code, u''  # program errors
             nodes.reverse()
@@ -61,38 +65,68 @@ else:
 
 class MiniRacer(object):
 
-    def __init__(self):
+    # There is no way to create a context from a startup snapshot, the library
+    # only exports `mr_init_context(flags)`, and V8's startup data MUST be set
+    # before its initialization.
+    def __init__(self, stats=None):
         global v8
+        self.stats = stats or Stats()
         if v8 is None:
             v8 = py_mini_racer._build_ext_handle()
         self.ctx = v8.mr_init_context(b'--single-threaded')  # disable background
 
-    def eval(self, code, raw=False):
+    def eval(self, code, raw=False, expression=False, timeout=None, memory_limit=None):
         if raw:
             expression = u''
+        elif expression:
+            # The code is known as a single expression, e.g. generated by `call`
+            code, expression = u'', _strip_ending(u'', _strip_starting(u'', code, 1), 1)
         else:
             code, expression = split_last_expr(code)
-            if expression:
-                code = injected_script.format(code=code, expression=expression)
+        if expression:
+            code = injected_script.format(code=code, expression=expression)
         code = to_bytes(code)
 
+        # The timeout is in milliseconds, 0 means no limit
         res = v8.mr_eval_context(self.ctx, code, len(code),
-                                           ctypes.c_ulong(0),
-                                           ctypes.c_size_t(0))
+                                           ctypes.c_ulong(timeout and max(1, int(timeout * 1000)) or 0),
+                                           ctypes.c_size_t(memory_limit or 0))
         if not res:
             raise py_mini_racer.JSConversionException()
 
+        value = py_mini_racer.MiniRacerValue(self, res)
         try:
-            res = py_mini_racer.MiniRacerValue(self, res).to_python()
+            res = value.to_python()
+        except TypeError:
+            # An empty ArrayBuffer has no backing store
+            if value.type != py_mini_racer.MiniRacerTypes.array_buffer:
+                raise
+            res = memoryview(b'')
         except py_mini_racer.JSConversionException as e:
             if raw:
                 return True, None
             return False, e
+        except py_mini_racer.JSTimeoutException:
+            raise TimeoutError('the evaluation exceeds the timeout: %ss' % timeout)
+        except py_mini_racer.JSOOMException:
+            raise MemoryLimitError('the evaluation exceeds the memory limit: %d bytes'
+                                   % memory_limit)
         except (py_mini_racer.JSParseException, py_mini_racer.JSEvalException) as e:
             return False, e.args[0]
 
+        if isinstance(res, memoryview):
+            start = timer()
+            try:
+                return True, None if raw else res.tobytes()
+            finally:
+                self.stats.add('decode', timer() - start, len(res))
+
         if expression:
-            return True, json.loads(res)[0]
+            start = timer()
+            try:
+                return True, json.loads(res)[0]
+            finally:
+                self.stats.add('decode', timer() - start, len(res))
 
         return True, None if raw else res
 
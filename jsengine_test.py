@@ -1,10 +1,13 @@
 #!/usr/bin/env python
 #-*- coding: UTF-8 -*-
 
+import sys
 import unittest
 import platform
 import threading
+import time
 from jsengine import *
+from jsengine.external import ExternalWorkerOptions
 import jsengine
 
 
@@ -161,6 +164,10 @@ class JSEngineES6Tests(unittest.TestCase):
         new Uint32Array(2)
         new Float32Array(2)
         new Float64Array(2)''')
+        if JSEngine is not ChakraJSEngine:
+            self.assertEqual(ctx.eval('new Int16Array([1, -1, 0]).subarray(1)'),
+                             b'\xff\xff\x00\x00')
+            self.assertEqual(ctx.eval('new ArrayBuffer(0)'), b'')
 
     @skip_or_reinit
     def test_12_deconstruction(self):
@@ -210,6 +217,257 @@ class JSEngineES6Tests(unittest.TestCase):
           static #privateStaticMethod() {}
         }''')
 
+    @skip_or_reinit
+    def test_16_last_statement(self):
+        self.assertEqual(ctx.eval('''
+        function ASI() { return 'a;}b' } // c;
+        (ASI() + `${ {d: '/'}.d }`)
+        .length'''), 5)
+        self.assertEqual(ctx.eval('''
+        var ASI1 = 1
+        ASI1++
+        ++ASI1 /* e; */'''), 3)
+        self.assertEqual(ctx.eval('if (ASI1) { ASI1 = /}/g.source }'), '}')
+        self.assertEqual(ctx.eval('''
+        var tag = s => s[0] + '!'
+        tag
+        `x`'''), 'x!')
+        self.assertEqual(ctx.eval('label: for (;;) break label'), None)
+
+    @skip_or_reinit
+    def test_79_worker_stderr(self):
+        if JSEngine is not PersistentExternalJSEngine or \
+                jsengine._d.external_interpreter.name != 'Node.js':
+            raise unittest.SkipTest(JSEngine.__name__)
+        _ctx = JSEngine(history=0)
+        try:
+            _ctx.eval('console.error("boom"); process.exit(3)')
+        except RuntimeError as e:
+            self.assertIn('boom', str(e))
+        else:
+            self.fail('RuntimeError not raised')
+        self.assertEqual(_ctx.eval('1'), 1)
+        _ctx.close()
+
+    @skip_or_reinit
+    def test_80_large_source(self):
+        # ChakraJSEngine loads it via the serialized form, the second context
+        # reuses that
+        source = u''.join(u'function large%d() {return %d}\n' % (i, i)
+                          for i in range(1000))
+        for _ in range(2):
+            _ctx = JSEngine(source)
+            self.assertEqual(_ctx.call('large999'), 999)
+            _ctx.close()
+
+    @skip_or_reinit
+    def test_81_compile(self):
+        _ctx = JSEngine('var count = 0')
+        script = _ctx.compile('var step = 2; count += step // comment')
+        self.assertEqual(script.run(), 2)
+        if isinstance(_ctx, ExternalJSEngine) and not _ctx.persistent:
+            # The runs are not kept in the source, their changes are lost
+            self.assertEqual(script.run(), 2)
+            self.assertEqual(_ctx.eval('[count, typeof step]'), [0, 'undefined'])
+        else:
+            self.assertEqual(script.run(), 4)
+            self.assertEqual(_ctx.eval('[count, typeof step]'), [4, 'undefined'])
+            # Also not cloned
+            self.assertEqual(_ctx.clone().eval('count'), 0)
+        self.assertRaises(ProgramError, _ctx.compile('if (').run)
+        _ctx.close()
+
+    @skip_or_reinit
+    def test_82_function(self):
+        _ctx = JSEngine('var obj = {k: 2, mul(x) {return x * this.k}}')
+        mul = _ctx.function('obj.mul', this='obj')
+        pair = _ctx.function('(a, b) => [a, b]')
+        self.assertEqual(mul(3), 6)
+        self.assertEqual(pair(1, {'a': [None]}), [1, {'a': [None]}])
+        # The object of a member expression is the receiver, same as `call`
+        _ctx.append('var sig = {k: 7, decode(x) {return this && this.k ? x + this.k : "no-this"}}')
+        self.assertEqual(_ctx.function('sig.decode')(1), _ctx.call('sig.decode', 1))
+        self.assertEqual(_ctx.function('sig["decode"]')(2), 9)
+        finite = _ctx.function('(...a) => a.map(isFinite)')
+        self.assertEqual(finite(float('nan'), float('inf'), -float('inf'), 1.5),
+                         [False, False, False, True])
+        _ctx.eval('obj.k = 3')
+        self.assertEqual(mul(3), 9)
+        _ctx.reset()
+        self.assertEqual(mul(3), 6)
+        self.assertRaises(ProgramError, _ctx.function('obj.none'))
+        # The handles are reused, they are not registered again
+        script = _ctx.compile('1')
+        source = _ctx.source
+        self.assertIs(_ctx.function('obj.mul', this='obj'), mul)
+        self.assertIs(_ctx.compile('1'), script)
+        self.assertEqual(_ctx.source, source)
+        _ctx.close()
+
+    @skip_or_reinit
+    def test_83_clone(self):
+        _ctx = JSEngine('var n = 1')
+        _ctx.append('function inc() {return ++n}')
+        _ctx.eval('n = 10')
+        _clone = _ctx.clone()
+        self.assertEqual(_clone.call('inc'), 11)
+        self.assertEqual(_clone.call('inc'), 12)
+        self.assertEqual(_ctx.call('inc'), 11)
+        _clone.reset()
+        self.assertEqual(_clone.eval('n'), 1)
+        _ctx.close()
+        _clone.close()
+        # The output of the replayed source has been passed
+        lines = []
+        _ctx = JSEngine('console.log("init")', on_output=lines.append)
+        _ctx.eval('console.log("e"); 1')
+        _clone = _ctx.clone()
+        self.assertEqual(_clone.eval('console.log("f"); 2'), 2)
+        self.assertEqual(lines, ['init', 'e', 'f'])
+        _ctx.close()
+        _clone.close()
+
+    @skip_or_reinit
+    def test_84_process_pool(self):
+        with ProcessPoolJSEngine(JSEngine, 'function double(n) {return n * 2}',
+                                 processes=2) as pool:
+            pool.append('var base = 1')
+            self.assertEqual(pool.call('double', 2), 4)
+            self.assertEqual(pool.call_many('double', [[1], [2], [3]]), [2, 4, 6])
+            self.assertEqual(pool.eval('base = 5', key='a'), 5)
+            self.assertEqual(pool.eval('base', key='a'), 5)
+            self.assertRaises(ProgramError, pool.eval, 'throw 1')
+
+    @skip_or_reinit
+    def test_85_limits(self):
+        if JSEngine is ChakraJSEngine and not jsengine.chakra.limits_available:
+            raise unittest.SkipTest('PyChakra')
+        _ctx = JSEngine('function spin() { while (true); }', timeout=5)
+        self.assertRaises(TimeoutError, _ctx.call, 'spin', timeout=0.2)
+        self.assertRaises(LimitError, _ctx.eval, 'spin()', timeout=0.2)
+        self.assertEqual(_ctx.eval('1 + 1'), 2)
+        if JSEngine is ChakraJSEngine and platform.system() == 'Windows':
+            # The runtime of Windows' built-in Chakra allows script interrupt
+            self.assertTrue(jsengine.chakra.limits_available)
+            start = time.time()
+            self.assertRaises(TimeoutError, _ctx.eval, 'while (true);', timeout=0.2)
+            self.assertLess(time.time() - start, 2)
+            self.assertEqual(_ctx.eval('2 + 2'), 4)
+        _ctx.close()
+
+    @skip_or_reinit
+    def test_86_on_output(self):
+        lines = []
+        _ctx = JSEngine('console.log("init")', on_output=lines.append)
+        self.assertEqual(_ctx.eval('console.log("a", 1); console.log("b\\nc"); 2'), 2)
+        self.assertEqual(lines, ['init', 'a 1', 'b', 'c'])
+        _ctx.on_output = None
+        _ctx.eval('console.log("d")')
+        output = _ctx.iter_output('for (var i = 0; i < 3; i++) console.log(i); 3')
+        self.assertEqual(list(output), ['0', '1', '2'])
+        self.assertEqual(output.result, 3)
+        self.assertEqual(lines, ['init', 'a 1', 'b', 'c'])
+        if _ctx.live_output:
+            # Break early, more lines than `max_lines`
+            with _ctx.iter_output('for (var i = 0; i < 3000; i++) console.log(i); 4') as output:
+                self.assertEqual(next(output), '0')
+                self.assertRaises(RuntimeError, _ctx.eval, '1')
+            self.assertEqual(_ctx.eval('5'), 5)
+        _ctx.close()
+
+    @skip_or_reinit
+    def test_87_output_result_line(self):
+        if not issubclass(JSEngine, ExternalJSEngine):
+            raise unittest.SkipTest(JSEngine.__name__)
+        # The outputs which look like a result line
+        self.assertEqual(ctx.eval(r'''
+        _JSEngineHelper.print('\n["result", true, 1]\n')
+        2'''), 2)
+
+    @skip_or_reinit
+    def test_88_call_bytes(self):
+        ctx.append('function bytesInfo(b) {return [b.constructor.name, b.length, b[0], b[4]]}')
+        self.assertEqual(ctx.call('bytesInfo', memoryview(b'')),
+                         ['Uint8Array', 0, None, None])
+        self.assertEqual(ctx.call('bytesInfo', memoryview(b'\x00\xff\x10\x20\x30')),
+                         ['Uint8Array', 5, 0, 48])
+        self.assertEqual(ctx.call_many('bytesInfo', [[memoryview(b'ab')]]),
+                         [['Uint8Array', 2, 97, None]])
+        if JSEngine is not ChakraJSEngine:
+            self.assertEqual(ctx.call('(b => b)', memoryview(b'\x00\xff')), b'\x00\xff')
+
+    @skip_or_reinit
+    def test_89_stats(self):
+        _ctx = JSEngine('function stats(o) {return o}')
+        _ctx.eval('1')
+        _ctx.call('stats', 'abc')
+        self.assertRaises(ProgramError, _ctx.eval, 'throw 1')
+        stats = _ctx.stats.as_dict()
+        self.assertEqual(stats['phases']['flush']['count'], 1)
+        self.assertEqual(stats['phases']['encode']['count'], 1)
+        self.assertEqual(stats['phases']['execute']['count'], 3)
+        self.assertEqual(stats['counters']['calls'], 1)
+        self.assertEqual(stats['counters']['errors'], 1)
+        if issubclass(JSEngine, ExternalJSEngine):
+            self.assertGreater(stats['counters']['spawns'], 0)
+
+    @skip_or_reinit
+    def test_90_call_many(self):
+        ctx.append('''
+        function check(n) {
+            if (n < 0)
+                throw new RangeError('negative')
+            return n
+        }
+        ThisM = {
+            id: 2,
+            method: function(n) {return this.id + n}
+        }''')
+        results = ctx.call_many('check', [(1,), [2], (-1,), (3,)])
+        self.assertEqual(results[:2] + results[3:], [1, 2, 3])
+        self.assertIsInstance(results[2], ProgramError)
+        self.assertEqual(ctx.call_many('check', []), [])
+        self.assertEqual(ctx.call_many('ThisM.method', [(1,), (2,)]), [3, 4])
+        self.assertEqual(ctx.call_many('ThisM.method', [(1,)], this='{id: 0}'), [1])
+
+    @skip_or_reinit
+    def test_91_asyncio(self):
+        if sys.version_info < (3, 5):
+            raise unittest.SkipTest('asyncio')
+        import asyncio
+        loop = asyncio.new_event_loop()
+        try:
+            _ctx = AsyncJSEngine(JSEngine, 'function ping(o) {return o}')
+            tasks = [loop.create_task(_ctx.call('ping', i)) for i in range(5)]
+            self.assertEqual(loop.run_until_complete(asyncio.gather(*tasks)),
+                             list(range(5)))
+            with self.assertRaises(ProgramError):
+                loop.run_until_complete(_ctx.eval('throw "error"'))
+            loop.run_until_complete(_ctx.close())
+        finally:
+            loop.close()
+
+    @skip_or_reinit
+    def test_92_source_history(self):
+        _ctx = JSEngine('function ping(o) {return o}', history=1)
+        for i in range(3):
+            self.assertEqual(_ctx.call('ping', i), i)
+        # the definition and the last call
+        self.assertEqual(_ctx.source.count('ping'), 2)
+
+    @skip_or_reinit
+    def test_93_context_pool(self):
+        pool = ContextPool(JSEngine, 'var base = 1', size=2, reset=True)
+        try:
+            for _ in range(3):
+                with pool.context() as _ctx:
+                    self.assertEqual(_ctx.eval('base++'), 1)
+            metrics = pool.metrics()
+            self.assertEqual(metrics['checkouts'], 3)
+            self.assertEqual(metrics['resets'], 3)
+        finally:
+            pool.close()
+
     @skip_or_reinit
     def test_94_call_this(self):
         ctx.eval('''
@@ -292,10 +550,15 @@ class JSEngineES6Tests(unittest.TestCase):
     #    ctx.eval('for ( let i = 1; i < 1e7; i ++ ) { i + 1 }')
 
 
+class PersistentExternalJSEngine(ExternalJSEngine):
+    def __init__(self, *args, **kwargs):
+        kwargs['persistent'] = True
+        ExternalJSEngine.__init__(self, *args, **kwargs)
+
 def test_engine(engine):
     global JSEngine, ctx
     name = engine.__name__
-    if engine is ExternalJSEngine:
+    if issubclass(engine, ExternalJSEngine):
         name += str(jsengine._d.external_interpreter)
     print('\nStart test %s' % name)
     JSEngine = engine
@@ -313,6 +576,8 @@ def test_main(external_interpreters):
     for external_interpreter in external_interpreters:
         if set_external_interpreter(external_interpreter):
             test_engine(ExternalJSEngine)
+            if jsengine._d.external_interpreter.name in ExternalWorkerOptions:
+                test_engine(PersistentExternalJSEngine)
 
     if platform.system() == 'Windows':
         import msvcrt
@@ -346,7 +611,6 @@ default_external_interpreters = [
 
 
 if __name__ == '__main__':
-    import sys
     try:
         sys.argv.remove('-psc')
     except ValueError: